@@ -0,0 +1,208 @@
+import asyncio
+import bisect
+import logging
+import time
+from collections import namedtuple
+from background import BackgroundService
+
+log = logging.getLogger(__name__)
+
+Alert = namedtuple('Alert', 'id user_id asset_type asset_name direction threshold')
+
+ABOVE = 'above'
+BELOW = 'below'
+
+# Отсортированные пороги алертов одного символа: пара параллельных списков (порог, id)
+class _Thresholds:
+    def __init__(self):
+        self.values = []
+        self.ids = []
+
+    def add(self, threshold, alert_id):
+        position = bisect.bisect_right(self.values, threshold)
+        self.values.insert(position, threshold)
+        self.ids.insert(position, alert_id)
+
+    def remove(self, threshold, alert_id):
+        position = bisect.bisect_left(self.values, threshold)
+        while position < len(self.values) and self.values[position] == threshold:
+            if self.ids[position] == alert_id:
+                del self.values[position]
+                del self.ids[position]
+                return
+            position += 1
+
+# Индекс алертов: для каждого символа верхние и нижние пороги отсортированы,
+# поэтому сработавшие алерты находятся одним бинарным поиском на тик цены
+class AlertIndex:
+    def __init__(self):
+        self._alerts = {}  # {id: Alert}
+        self._upper = {}  # {(asset_type, asset_name): пороги "выше"}
+        self._lower = {}  # {(asset_type, asset_name): пороги "ниже"}
+
+    def __len__(self):
+        return len(self._alerts)
+
+    def add(self, alert: Alert):
+        self._alerts[alert.id] = alert
+        side = self._upper if alert.direction == ABOVE else self._lower
+        side.setdefault((alert.asset_type, alert.asset_name), _Thresholds()).add(alert.threshold, alert.id)
+
+    def remove(self, alert_id):
+        alert = self._alerts.pop(alert_id, None)
+        if alert is None:
+            return None
+        side = self._upper if alert.direction == ABOVE else self._lower
+        key = (alert.asset_type, alert.asset_name)
+        thresholds = side[key]
+        thresholds.remove(alert.threshold, alert.id)
+        if not thresholds.values:
+            del side[key]
+        return alert
+
+    # Символы, по которым есть активные алерты: [(asset_type, asset_name)]
+    def symbols(self):
+        return sorted(set(self._upper) | set(self._lower))
+
+    def triggered(self, asset_type, asset_name, price):
+        key = (asset_type, asset_name)
+        ids = []
+        upper = self._upper.get(key)
+        if upper is not None:
+            # Алерт "выше X" срабатывает при цене >= X: это префикс отсортированного списка
+            ids.extend(upper.ids[:bisect.bisect_right(upper.values, price)])
+        lower = self._lower.get(key)
+        if lower is not None:
+            # Алерт "ниже X" срабатывает при цене <= X: это суффикс списка
+            ids.extend(lower.ids[bisect.bisect_left(lower.values, price):])
+        return [self._alerts[alert_id] for alert_id in ids]
+
+# Движок алертов: активные алерты из таблицы alerts держатся в индексе в памяти.
+# Цены берутся пакетно по всем символам сразу (число запросов к поставщикам зависит
+# только от числа различных символов), а потоковые тики проверяются сразу по приходу.
+class AlertEngine(BackgroundService):
+    def __init__(self, db, valuer, notify, interval=60):
+        self.db = db
+        self.valuer = valuer
+        self.notify = notify  # корутина notify(alert, price)
+        self.interval = interval
+        self.index = AlertIndex()
+        db.call(_create_tables)
+
+    async def load(self):
+        for row in await self.db.run(_active_alerts):
+            self.index.add(Alert(*row))
+
+    async def add(self, user_id, asset_type, asset_name, direction, threshold):
+        alert_id = await self.db.run(_insert_alert, user_id, asset_type, asset_name, direction, threshold, time.time())
+        alert = Alert(alert_id, user_id, asset_type, asset_name, direction, threshold)
+        self.index.add(alert)
+        return alert
+
+    async def remove(self, user_id, alert_id):
+        if not await self.db.run(_delete_alert, user_id, alert_id):
+            return False
+        self.index.remove(alert_id)
+        return True
+
+    async def user_alerts(self, user_id):
+        return [Alert(*row) for row in await self.db.run(_user_alerts, user_id)]
+
+    # Пары Binance, по которым есть алерты - их нужно держать в подписке потока
+    def crypto_pairs(self):
+        return {f"{asset_name}USDT" for asset_type, asset_name in self.index.symbols() if asset_type == 'crypto'}
+
+    # Тик из потока Binance
+    def on_tick(self, symbol, price):
+        if symbol.endswith('USDT') and self.index.triggered('crypto', symbol[:-4], price):
+            asyncio.ensure_future(self.check('crypto', symbol[:-4], price))
+
+    async def check(self, asset_type, asset_name, price):
+        alerts = self.index.triggered(asset_type, asset_name, price)
+        if not alerts:
+            return
+        # Алерт срабатывает один раз: сначала убираем его из индекса, чтобы следующий тик его не повторил
+        for alert in alerts:
+            self.index.remove(alert.id)
+        # Уведомляем только об алертах, которые отметил этот процесс: остальные
+        # уже сработали в другой реплике или удалены пользователем
+        claimed = await self.db.run(_claim_triggered, [alert.id for alert in alerts], time.time())
+        for alert in alerts:
+            if alert.id not in claimed:
+                continue
+            try:
+                await self.notify(alert, price)
+            except Exception:
+                log.exception("Failed to send alert %s", alert.id)
+
+    # Один цикл проверки: одна пакетная оценка всех символов с активными алертами
+    async def evaluate(self):
+        symbols = self.index.symbols()
+        if not symbols:
+            return
+        prices = await self.valuer.price((asset_name, asset_type) for asset_type, asset_name in symbols)
+        for (asset_type, asset_name), price in prices.items():
+            if isinstance(price, float):
+                await self.check(asset_type, asset_name, price)
+
+    async def _run(self):
+        await self.load()
+        while True:
+            try:
+                await self.evaluate()
+            except Exception:
+                log.exception("Alert evaluation failed")
+            await asyncio.sleep(self.interval)
+
+
+def _create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS alerts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        asset_type TEXT,
+        asset_name TEXT,
+        direction TEXT, -- 'above', 'below'
+        threshold REAL,
+        created_at REAL,
+        triggered_at REAL,
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS alerts_user ON alerts (user_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS alerts_active ON alerts (triggered_at) WHERE triggered_at IS NULL')
+    conn.commit()
+
+def _active_alerts(conn):
+    return conn.execute('''
+        SELECT id, user_id, asset_type, asset_name, direction, threshold
+        FROM alerts WHERE triggered_at IS NULL
+    ''').fetchall()
+
+def _user_alerts(conn, user_id):
+    return conn.execute('''
+        SELECT id, user_id, asset_type, asset_name, direction, threshold
+        FROM alerts WHERE user_id = ? AND triggered_at IS NULL ORDER BY id
+    ''', (user_id,)).fetchall()
+
+def _insert_alert(conn, user_id, asset_type, asset_name, direction, threshold, created_at):
+    cursor = conn.execute('''
+        INSERT INTO alerts (user_id, asset_type, asset_name, direction, threshold, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, asset_type, asset_name, direction, threshold, created_at))
+    conn.commit()
+    return cursor.lastrowid
+
+def _delete_alert(conn, user_id, alert_id):
+    cursor = conn.execute('DELETE FROM alerts WHERE id = ? AND user_id = ? AND triggered_at IS NULL', (alert_id, user_id))
+    conn.commit()
+    return cursor.rowcount > 0
+
+def _claim_triggered(conn, alert_ids, triggered_at):
+    with conn:
+        rows = conn.execute(f'''
+            UPDATE alerts SET triggered_at = ?
+            WHERE id IN ({','.join('?' * len(alert_ids))}) AND triggered_at IS NULL
+            RETURNING id
+        ''', (triggered_at, *alert_ids)).fetchall()
+    return {alert_id for (alert_id,) in rows}
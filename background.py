@@ -0,0 +1,23 @@
+import asyncio
+
+# Фоновый цикл сервиса (алерты, история, сводки, поток Binance, списки тикеров).
+# Сервис реализует корутину _run(), а запуск и остановка общие: start() повторно
+# задачу не создаёт, stop() отменяет её и дожидается завершения.
+class BackgroundService:
+    _task = None
+
+    def start(self, *args):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run(*args))
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            # Отмена самой остановки (а не фоновой задачи) пробрасывается дальше
+            if asyncio.current_task().cancelling():
+                raise
@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from aiohttp import web
+
+# Нагрузочный тест диспетчера: синтетические обновления Telegram подаются прямо в dp.process_update,
+# поставщики цен и Bot API заменены локальной заглушкой с настраиваемой задержкой,
+# база заранее заполнена пользователями и активами. Результаты пишутся в JSON для сравнения коммитов.
+#
+#   python benchmark.py --users 1000 --portfolio-sizes 1,10,50 --concurrency 1,16,64 --output bench.json
+
+CURRENCIES = ['USD', 'EUR', 'CNY', 'GBP', 'JPY', 'CHF', 'KZT', 'TRY', 'INR', 'AED']
+
+# Локальная заглушка ЦБ РФ, Binance, Alpha Vantage и Telegram Bot API
+class FakeUpstreams:
+    def __init__(self, latency, jitter=0.0, seed=0):
+        self.latency = latency  # {'cbr': с, 'binance': с, 'alphavantage': с, 'telegram': с}
+        self.jitter = jitter  # доля случайного разброса задержки
+        self.calls = {name: 0 for name in latency}
+        self._random = random.Random(seed)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/cbr/daily_json.js', self.cbr_daily)
+        app.router.add_get('/binance/api/v3/ticker/price', self.binance_ticker)
+        app.router.add_get('/binance/api/v3/exchangeInfo', self.binance_exchange_info)
+        app.router.add_get('/alphavantage/query', self.alpha_vantage_query)
+        app.router.add_post('/telegram/bot{token}/{method}', self.telegram_method)
+        return app
+
+    async def _delay(self, name):
+        self.calls[name] += 1
+        latency = self.latency.get(name, 0.0)
+        if latency:
+            await asyncio.sleep(latency * (1 + self._random.uniform(-self.jitter, self.jitter)))
+
+    async def cbr_daily(self, request):
+        await self._delay('cbr')
+        return web.json_response({
+            'Timestamp': '2024-10-17T20:00:00+03:00',
+            'NextDate': '2099-01-01T11:30:00+03:00',
+            'Valute': {
+                code: {'CharCode': code, 'Nominal': 1, 'Value': 10.0 + position}
+                for position, code in enumerate(CURRENCIES)
+            },
+        })
+
+    async def binance_ticker(self, request):
+        await self._delay('binance')
+        if 'symbol' in request.query:
+            return web.json_response({'symbol': request.query['symbol'], 'price': '100.0'})
+        symbols = json.loads(request.query.get('symbols', '[]')) or [f"C{n:03d}USDT" for n in range(100)]
+        return web.json_response([{'symbol': symbol, 'price': '100.0'} for symbol in symbols])
+
+    async def binance_exchange_info(self, request):
+        await self._delay('binance')
+        return web.json_response({'symbols': [
+            {'baseAsset': f"C{n:03d}", 'quoteAsset': 'USDT', 'status': 'TRADING'} for n in range(100)
+        ]})
+
+    async def alpha_vantage_query(self, request):
+        await self._delay('alphavantage')
+        symbol = request.query.get('symbol', '')
+        return web.json_response({'Global Quote': {
+            '01. symbol': symbol, '05. price': '50.0', '07. latest trading day': time.strftime('%Y-%m-%d'),
+        }})
+
+    async def telegram_method(self, request):
+        await self._delay('telegram')
+        data = await request.post()
+        return web.json_response({'ok': True, 'result': {
+            'message_id': 1,
+            'date': int(time.time()),
+            'chat': {'id': int(data.get('chat_id', 0)), 'type': 'private'},
+            'text': data.get('text', ''),
+        }})
+
+
+# Пользователи с портфелями заданного размера: {размер: [user_id]}
+def seed_database(db, users, portfolio_sizes, seed=0):
+    generator = random.Random(seed)
+    assets = (
+        [(f"C{n:03d}", 'crypto') for n in range(100)]
+        + [(code, 'currency') for code in CURRENCIES]
+        + [(f"S{n:03d}", 'stock') for n in range(20)]
+    )
+    groups = {}
+    user_rows = []
+    portfolio_rows = []
+    user_id = 1
+    for size in portfolio_sizes:
+        groups[size] = []
+        for _ in range(users):
+            groups[size].append(user_id)
+            user_rows.append((user_id, f"user{user_id}"))
+            for asset_name, asset_type in generator.sample(assets, min(size, len(assets))):
+                portfolio_rows.append((user_id, asset_name, round(generator.uniform(0.1, 100), 4), asset_type))
+            user_id += 1
+
+    def insert(conn):
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)', user_rows)
+            conn.executemany(
+                'INSERT INTO portfolio (user_id, asset_name, amount, asset_type) VALUES (?, ?, ?, ?)', portfolio_rows
+            )
+    db.call(insert)
+    return groups
+
+def make_update(update_id, user_id, text):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench', 'username': f"user{user_id}"},
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+# Сценарии: текст сообщения, которое отправляет пользователь
+SCENARIOS = {
+    'start': '/start',
+    'portfolio': 'Портфель',
+    'history': '/history 1d',
+    'alerts': '/alerts',
+}
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else None
+
+async def run_scenario(dp, types, upstreams, name, user_ids, updates, concurrency, update_ids):
+    text = SCENARIOS[name]
+    latencies = []
+    errors = 0
+    limit = asyncio.Semaphore(concurrency)
+    calls_before = dict(upstreams.calls)
+
+    async def feed(user_id):
+        nonlocal errors
+        update = types.Update(**make_update(next(update_ids), user_id, text))
+        async with limit:
+            started = time.perf_counter()
+            try:
+                await dp.process_update(update)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(user_ids[n % len(user_ids)]) for n in range(updates)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'updates': updates,
+        'concurrency': concurrency,
+        'errors': errors,
+        'elapsed_s': round(elapsed, 4),
+        'throughput_ups': round(updates / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            key: round(percentile(latencies, q) * 1000, 3)
+            for key, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))
+        },
+        'upstream_calls': {key: upstreams.calls[key] - calls_before[key] for key in upstreams.calls},
+    }
+
+def memory_snapshot():
+    # ru_maxrss в Linux - килобайты
+    snapshot = {'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)}
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot['traced_current_mb'] = round(current / 2 ** 20, 2)
+        snapshot['traced_peak_mb'] = round(peak / 2 ** 20, 2)
+    return snapshot
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run(args):
+    upstreams = FakeUpstreams(
+        {'cbr': args.cbr_latency, 'binance': args.binance_latency,
+         'alphavantage': args.alphavantage_latency, 'telegram': args.telegram_latency},
+        jitter=args.jitter, seed=args.seed,
+    )
+    runner = web.AppRunner(upstreams.app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    base = f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+    # Окружение задаётся до создания сервисов: бот и поставщики смотрят на заглушку
+    os.environ.update({
+        'API_TOKEN': '123456:benchmark',
+        'DATABASE_PATH': os.path.join(tempfile.mkdtemp(), 'bench.db'),
+        'TELEGRAM_API_URL': f"{base}/telegram",
+        'CBR_URL': f"{base}/cbr",
+        'BINANCE_URL': f"{base}/binance",
+        'ALPHAVANTAGE_URL': f"{base}/alphavantage",
+        'AV_API_KEY': 'benchmark',
+        'AV_PER_MINUTE': '1000000',
+        'AV_PER_DAY': '1000000',
+    })
+    os.environ.pop('BINANCE_STREAM', None)
+    import main
+    from aiogram import Bot, Dispatcher, types
+
+    dp = main.create_app()
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    groups = seed_database(main.db, args.users, args.portfolio_sizes, seed=args.seed)
+    update_ids = iter(range(1, 10 ** 9))
+
+    if args.trace_memory:
+        tracemalloc.start()
+    results = []
+    for scenario in args.scenarios:
+        sizes = args.portfolio_sizes if scenario in ('portfolio', 'history') else args.portfolio_sizes[:1]
+        for size in sizes:
+            for concurrency in args.concurrency:
+                if args.warmup:
+                    await run_scenario(dp, types, upstreams, scenario, groups[size], args.warmup, concurrency, update_ids)
+                result = await run_scenario(
+                    dp, types, upstreams, scenario, groups[size], args.updates, concurrency, update_ids
+                )
+                result.update({'scenario': scenario, 'portfolio_size': size, 'memory': memory_snapshot()})
+                results.append(result)
+                print(
+                    f"{scenario:10} size={size:<4} concurrency={concurrency:<4} "
+                    f"{result['throughput_ups']:>9} upd/s  p50={result['latency_ms']['p50']} ms  "
+                    f"p99={result['latency_ms']['p99']} ms  errors={result['errors']}",
+                    file=sys.stderr,
+                )
+
+    await main.on_shutdown(dp)
+    session = await dp.bot.get_session()
+    await session.close()
+    await runner.cleanup()
+    return {
+        'commit': git_commit(),
+        'timestamp': int(time.time()),
+        'python': sys.version.split()[0],
+        'config': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': results,
+    }
+
+def parse_args(argv=None):
+    def numbers(value):
+        return [int(item) for item in value.split(',') if item]
+
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота")
+    parser.add_argument('--users', type=int, default=200, help="пользователей на каждый размер портфеля")
+    parser.add_argument('--portfolio-sizes', type=numbers, default=[1, 10, 50])
+    parser.add_argument('--updates', type=int, default=500, help="обновлений на каждый прогон")
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--concurrency', type=numbers, default=[1, 16, 64])
+    parser.add_argument('--scenarios', type=lambda value: value.split(','), default=list(SCENARIOS))
+    parser.add_argument('--cbr-latency', type=float, default=0.05)
+    parser.add_argument('--binance-latency', type=float, default=0.03)
+    parser.add_argument('--alphavantage-latency', type=float, default=0.2)
+    parser.add_argument('--telegram-latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace-memory', action='store_true', help="считать пик выделенной памяти через tracemalloc")
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    report = asyncio.run(run(args))
+    with open(args.output, 'w') as file:
+        json.dump(report, file, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}", file=sys.stderr)
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+import aiohttp
+from background import BackgroundService
+
+log = logging.getLogger(__name__)
+
+# Таблица последних цен из потока: {символ: (цена, время получения)}
+class PriceTable:
+    def __init__(self, max_age=30.0):
+        self.max_age = max_age  # порог устаревания цены в секундах
+        self._prices = {}
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, symbol, price, received_at=None):
+        if received_at is None:
+            received_at = time.time()
+        self._prices[symbol] = (price, received_at)
+
+    # Свежая цена символа или None, если цены нет или она устарела
+    def get(self, symbol):
+        entry = self._prices.get(symbol)
+        if entry is None or time.time() - entry[1] > self.max_age:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def __len__(self):
+        return len(self._prices)
+
+# Поток мини-тикеров Binance. Подписка держится только на символы из портфелей
+# и недавно запрошенные символы, чтобы котировки отдавались из памяти без REST-запросов.
+class BinanceStream(BackgroundService):
+    base_url = 'wss://stream.binance.com:9443'
+    max_streams = 1024  # ограничение Binance на число потоков в одном соединении
+
+    def __init__(self, http, table: PriceTable, portfolio_symbols, base_url=None, recent_ttl=3600, refresh=30):
+        self.http = http
+        self.table = table
+        self.portfolio_symbols = portfolio_symbols  # корутина, возвращающая символы из таблицы portfolio
+        self.base_url = base_url or self.base_url
+        self.recent_ttl = recent_ttl
+        self.refresh = refresh
+        self._recent = {}  # {символ: время последнего запроса}
+        self.listeners = []  # функции listener(symbol, price), вызываемые на каждый тик
+        self._subscribed = set()
+        self._request_id = 0
+        self._wake = None
+
+    # Цена из потока; символ запоминается как недавно запрошенный, чтобы подписаться на него
+    def quote(self, symbol):
+        if symbol not in self._recent and symbol not in self._subscribed and self._wake is not None:
+            self._wake.set()
+        self._recent[symbol] = time.monotonic()
+        return self.table.get(symbol)
+
+    async def wanted(self):
+        deadline = time.monotonic() - self.recent_ttl
+        self._recent = {symbol: seen for symbol, seen in self._recent.items() if seen >= deadline}
+        symbols = set(await self.portfolio_symbols())
+        # Сначала символы портфелей, затем самые свежие из недавно запрошенных
+        for symbol in sorted(self._recent, key=self._recent.get, reverse=True):
+            if len(symbols) >= self.max_streams:
+                break
+            symbols.add(symbol)
+        if len(symbols) > self.max_streams:
+            symbols = set(sorted(symbols)[:self.max_streams])
+        return symbols
+
+    async def _run(self):
+        self._wake = asyncio.Event()
+        backoff = 1
+        while True:
+            try:
+                async with self.http.session().ws_connect(f"{self.base_url}/ws", heartbeat=60) as ws:
+                    self._subscribed = set()
+                    backoff = 1
+                    sync_task = asyncio.ensure_future(self._sync_loop(ws))
+                    try:
+                        async for msg in ws:
+                            if msg.type == aiohttp.WSMsgType.TEXT:
+                                self.handle(msg.json())
+                            elif msg.type == aiohttp.WSMsgType.ERROR:
+                                break
+                    finally:
+                        sync_task.cancel()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Binance stream disconnected: %s", e)
+            self._subscribed = set()
+            # Binance закрывает соединения раз в сутки - переподключаемся с нарастающей паузой
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def handle(self, data):
+        if isinstance(data, dict) and data.get('e') == '24hrMiniTicker':
+            symbol, price = data['s'], float(data['c'])
+            self.table.update(symbol, price)
+            for listener in self.listeners:
+                listener(symbol, price)
+
+    async def _sync_loop(self, ws):
+        while True:
+            await self._sync(ws)
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.refresh)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _sync(self, ws):
+        wanted = await self.wanted()
+        added = wanted - self._subscribed
+        removed = self._subscribed - wanted
+        if removed:
+            await self._send(ws, 'UNSUBSCRIBE', removed)
+        if added:
+            await self._send(ws, 'SUBSCRIBE', added)
+        self._subscribed = wanted
+
+    async def _send(self, ws, method, symbols):
+        self._request_id += 1
+        params = [f"{symbol.lower()}@miniTicker" for symbol in sorted(symbols)]
+        await ws.send_json({'method': method, 'params': params, 'id': self._request_id})
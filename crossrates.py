@@ -0,0 +1,126 @@
+from collections import namedtuple
+
+# NumPy импортируется при первой оценке, а не при импорте модуля:
+# запуск бота и тесты, которые не считают стоимость, его не загружают
+
+# Валюта, в которой поставщик отдаёт цену актива данного типа
+PRICE_UNITS = {'crypto': 'USDT', 'currency': 'RUB', 'stock': 'USD'}
+DEFAULT_BASE = 'USD'
+
+# Оценка одной строки портфеля: цена в валюте поставщика и стоимость в базовой валюте
+Holding = namedtuple('Holding', 'asset_name amount asset_type price unit value')
+
+# Матрица кросс-курсов одного снимка ленты ЦБ: matrix[i, j] - цена единицы валюты i в валюте j.
+# Все курсы ленты выражены в рублях, поэтому матрица - внешнее произведение рублёвых цен
+# на обратные им; USDT считается равным доллару (курс к USD задаётся usdt_usd).
+class CrossRates:
+    def __init__(self, codes, rub_prices):
+        import numpy as np
+        self.codes = list(codes)
+        self.index = {code: position for position, code in enumerate(self.codes)}
+        rub = np.asarray(rub_prices, dtype=float)
+        self.matrix = rub[:, None] / rub[None, :]
+
+    @classmethod
+    def from_cbr(cls, document, usdt_usd=1.0):
+        codes = ['RUB']
+        rub_prices = [1.0]
+        for code, item in document['Valute'].items():
+            codes.append(code)
+            rub_prices.append(item['Value'] / item['Nominal'])
+        if 'USD' in codes:
+            codes.append('USDT')
+            rub_prices.append(rub_prices[codes.index('USD')] * usdt_usd)
+        return cls(codes, rub_prices)
+
+    def __contains__(self, code):
+        return code in self.index
+
+    def rate(self, source, target):
+        return float(self.matrix[self.index[source], self.index[target]])
+
+# Векторная оценка строк портфелей: rows - (user_id, asset_name, amount, asset_type),
+# prices - {(asset_type, asset_name): цена или строка с ошибкой}, bases - {user_id: код валюты}.
+# Возвращает (user_ids, totals, values, unpriced): итоги по пользователям одним bincount,
+# стоимость каждой строки в базовой валюте её владельца (NaN без цены) и число строк без цены.
+def value_rows(rows, prices, rates: CrossRates, bases):
+    import numpy as np
+    count = len(rows)
+    user_column = np.fromiter((row[0] for row in rows), dtype=np.int64, count=count)
+    amounts = np.fromiter((row[2] for row in rows), dtype=float, count=count)
+    quotes = np.fromiter(
+        (_as_price(prices.get((row[3], row[1]))) for row in rows), dtype=float, count=count
+    )
+    units = np.fromiter(
+        (rates.index.get(PRICE_UNITS.get(row[3]), -1) for row in rows), dtype=np.int64, count=count
+    )
+    user_ids, owners = np.unique(user_column, return_inverse=True)
+    user_bases = np.fromiter(
+        (rates.index.get(bases.get(int(user_id), DEFAULT_BASE), rates.index[DEFAULT_BASE]) for user_id in user_ids),
+        dtype=np.int64, count=len(user_ids),
+    )
+    priced = ~np.isnan(quotes) & (units >= 0)
+    factors = np.where(priced, rates.matrix[np.maximum(units, 0), user_bases[owners]], np.nan)
+    values = amounts * quotes * factors
+    totals = np.bincount(owners, weights=np.where(priced, values, 0.0), minlength=len(user_ids))
+    unpriced = np.bincount(owners, weights=(~priced).astype(float), minlength=len(user_ids)).astype(np.int64)
+    return user_ids, totals, values, unpriced
+
+def _as_price(price):
+    return price if isinstance(price, float) else float('nan')
+
+# Оценка портфелей в базовой валюте пользователя. Матрица кросс-курсов строится один раз
+# на документ ленты ЦБ, цены активов запрашиваются одним пакетным вызовом Valuer
+# на все различные активы, сколько бы пользователей их ни держали.
+class PortfolioValuation:
+    def __init__(self, db, valuer, currency_rates):
+        self.db = db
+        self.valuer = valuer
+        self.currency_rates = currency_rates
+        self._document = None
+        self._rates = None
+
+    # cached=True - курсы из последней загруженной ленты, даже устаревшей; ЦБ запрашивается,
+    # только если лента в этом процессе ещё ни разу не загружалась
+    async def rates(self, cached=False):
+        document = self.currency_rates.peek() if cached else None
+        if document is None:
+            document = await self.currency_rates.get()
+        if document is not self._document:
+            self._rates = CrossRates.from_cbr(document)
+            self._document = document
+        return self._rates
+
+    # Портфель одного пользователя: ([Holding], итог, базовая валюта)
+    async def portfolio(self, user_id):
+        rows = [(user_id, *asset) for asset in await self.db.get_portfolio(user_id)]
+        base = await self.db.get_base_currency(user_id)
+        if not rows:
+            return [], 0.0, base
+        prices = await self.valuer.price((asset_name, asset_type) for _, asset_name, _, asset_type in rows)
+        rates = await self.rates()
+        _, totals, values, _ = value_rows(rows, prices, rates, {user_id: base})
+        holdings = [
+            Holding(asset_name, amount, asset_type, prices.get((asset_type, asset_name)),
+                    PRICE_UNITS.get(asset_type), float(value))
+            for (_, asset_name, amount, asset_type), value in zip(rows, values)
+        ]
+        return holdings, float(totals[0]), base
+
+    # Снимок для пакетной оценки: цены активов [(asset_name, asset_type)] и матрица курсов
+    async def snapshot(self, assets):
+        prices = await self.valuer.price(assets)
+        return prices, await self.rates()
+
+    # Итоги всех (или указанных) пользователей: {user_id: (итог, базовая валюта, строк без цены)}
+    async def totals(self, user_ids=None):
+        rows = await self.db.holdings(user_ids)
+        if not rows:
+            return {}
+        prices, rates = await self.snapshot({(asset_name, asset_type) for _, asset_name, _, asset_type in rows})
+        bases = await self.db.base_currencies(user_ids)
+        owners, totals, _, unpriced = value_rows(rows, prices, rates, bases)
+        return {
+            int(user_id): (float(total), bases.get(int(user_id), DEFAULT_BASE), int(missing))
+            for user_id, total, missing in zip(owners, totals, unpriced)
+        }
@@ -0,0 +1,265 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from aiogram.utils.exceptions import RetryAfter, BotBlocked, ChatNotFound, UserDeactivated, TelegramAPIError
+from crossrates import DEFAULT_BASE, value_rows
+from background import BackgroundService
+
+log = logging.getLogger(__name__)
+
+# Периоды рассылки: (длина цикла в секундах, заголовок сводки)
+PERIODS = {
+    'hourly': (3600, 'Ежечасная сводка'),
+    'daily': (86400, 'Ежедневная сводка'),
+}
+
+# Ведро токенов: не больше rate отправок в секунду с накоплением до capacity
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    # Ответ 429 от Telegram: все отправки ждут указанное время
+    def pause(self, seconds):
+        self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+# Ограничение отправок в один чат: не чаще раза в interval секунд
+class ChatLimiter:
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._next = {}  # {chat_id: время, раньше которого в чат писать нельзя}
+
+    async def acquire(self, chat_id):
+        now = time.monotonic()
+        if len(self._next) > 10000:
+            self._next = {chat: at for chat, at in self._next.items() if at > now}
+        at = max(self._next.get(chat_id, 0.0), now)
+        self._next[chat_id] = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+# Рассылка сводок по портфелям подписчиков. За цикл берётся один снимок цен и курсов,
+# подписчики читаются из базы порциями по chunk_size и оцениваются по этому снимку
+# одним векторным расчётом на порцию. Отправка идёт через глобальное ведро токенов
+# и ограничение на чат. Цикл захватывается одной репликой через аренду в digest_runs;
+# каждый получатель отмечается в digest_subscriptions сразу после отправки, а после
+# порции сохраняется последний обработанный пользователь, поэтому прерванный цикл
+# продолжается с места остановки и никому не отправляет сводку повторно.
+class DigestBroadcaster(BackgroundService):
+    def __init__(self, db, valuation, send, global_rate=30, chat_rate=1, chunk_size=500, workers=8,
+                 check_every=60, daily_hour=9, lease=300):
+        self.db = db
+        self.valuation = valuation
+        self.send = send  # корутина send(chat_id, text)
+        self.bucket = TokenBucket(global_rate)
+        self.chats = ChatLimiter(1 / chat_rate)
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.check_every = check_every
+        self.daily_hour = daily_hour  # час (UTC) ежедневной рассылки
+        self.lease = lease  # на сколько секунд реплика захватывает цикл; продлевается после каждой порции
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        db.call(_create_tables)
+
+    async def subscribe(self, user_id, period):
+        await self.db.run(_subscribe, user_id, period)
+
+    async def unsubscribe(self, user_id):
+        await self.db.run(_unsubscribe, user_id)
+
+    async def subscription(self, user_id):
+        return await self.db.run(_subscription, user_id)
+
+    # Начало текущего цикла периода
+    def cycle(self, period, now=None):
+        length = PERIODS[period][0]
+        offset = self.daily_hour * 3600 if period == 'daily' else 0
+        now = int(now if now is not None else time.time())
+        return (now - offset) // length * length + offset
+
+    async def run_cycle(self, period, cycle):
+        # Захват атомарный: цикл, который ведёт другая реплика с живой арендой, пропускается
+        claimed = await self.db.run(_claim_run, period, cycle, self.owner, time.time(), self.lease)
+        if claimed is None:
+            return 0
+        after = claimed[0]
+
+        assets = await self.db.run(_subscriber_assets, period)
+        if not assets:
+            await self.db.run(_save_run, period, cycle, self.owner, after, True, time.time())
+            return 0
+        prices, rates = await self.valuation.snapshot(assets)
+        sent = 0
+        while True:
+            user_ids = await self.db.run(_subscribers, period, cycle, after, self.chunk_size)
+            if not user_ids:
+                break
+            rows = await self.db.holdings(user_ids)
+            if rows:
+                bases = await self.db.base_currencies(user_ids)
+                owners, totals, _, unpriced = value_rows(rows, prices, rates, bases)
+                messages = [
+                    (int(user_id), _digest_text(period, total, bases.get(int(user_id), DEFAULT_BASE), missing))
+                    for user_id, total, missing in zip(owners, totals, unpriced)
+                ]
+                sent += await self._send_all(messages, cycle)
+            after = user_ids[-1]
+            if not await self.db.run(_save_run, period, cycle, self.owner, after, False, time.time() + self.lease):
+                log.warning("Digest %s cycle %s was taken over by another replica", period, cycle)
+                return sent
+        await self.db.run(_save_run, period, cycle, self.owner, after, True, time.time())
+        return sent
+
+    async def _send_all(self, messages, cycle):
+        limit = asyncio.Semaphore(self.workers)
+
+        async def deliver(chat_id, text):
+            async with limit:
+                if not await self._deliver(chat_id, text):
+                    return False
+                await self.db.run(_mark_sent, chat_id, cycle)
+                return True
+        results = await asyncio.gather(*(deliver(chat_id, text) for chat_id, text in messages))
+        return sum(results)
+
+    async def _deliver(self, chat_id, text, attempts=3):
+        await self.chats.acquire(chat_id)
+        for _ in range(attempts):
+            await self.bucket.acquire()
+            try:
+                await self.send(chat_id, text)
+                return True
+            except RetryAfter as e:
+                log.warning("Telegram flood control, pausing digest for %s s", e.timeout)
+                self.bucket.pause(e.timeout)
+            except (BotBlocked, ChatNotFound, UserDeactivated):
+                # Пользователь недоступен - больше ему не пишем
+                await self.unsubscribe(chat_id)
+                return False
+            except TelegramAPIError:
+                log.exception("Failed to send digest to %s", chat_id)
+                return False
+            except Exception:
+                # Сетевой сбой или таймаут - неудачная отправка одному пользователю, а не всей порции
+                log.exception("Failed to send digest to %s", chat_id)
+                return False
+        return False
+
+    async def _run(self):
+        while True:
+            for period in PERIODS:
+                try:
+                    await self.run_cycle(period, self.cycle(period))
+                except Exception:
+                    log.exception("Digest cycle %s failed", period)
+            await asyncio.sleep(self.check_every)
+
+
+def _digest_text(period, total, base, missing):
+    text = f"📊 {PERIODS[period][1]}: стоимость портфеля {total:.2f} {base}"
+    if missing:
+        text += f"\nБез цены: {missing} акт."
+    return text
+
+def _create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS digest_subscriptions (
+        user_id INTEGER PRIMARY KEY,
+        period TEXT, -- 'hourly', 'daily'
+        sent_cycle INTEGER -- цикл, сводка которого уже доставлена
+    )
+    ''')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(digest_subscriptions)')]
+    if 'sent_cycle' not in columns:
+        conn.execute('ALTER TABLE digest_subscriptions ADD COLUMN sent_cycle INTEGER')
+    conn.execute('CREATE INDEX IF NOT EXISTS digest_subscriptions_period ON digest_subscriptions (period, user_id)')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS digest_runs (
+        period TEXT PRIMARY KEY,
+        cycle INTEGER,
+        last_user_id INTEGER,
+        finished INTEGER,
+        owner TEXT, -- реплика, которая ведёт цикл
+        lease_until REAL
+    )
+    ''')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(digest_runs)')]
+    if 'owner' not in columns:
+        conn.execute('ALTER TABLE digest_runs ADD COLUMN owner TEXT')
+        conn.execute('ALTER TABLE digest_runs ADD COLUMN lease_until REAL')
+    conn.commit()
+
+def _subscribe(conn, user_id, period):
+    conn.execute('''
+        INSERT INTO digest_subscriptions (user_id, period) VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET period = excluded.period
+    ''', (user_id, period))
+    conn.commit()
+
+def _unsubscribe(conn, user_id):
+    conn.execute('DELETE FROM digest_subscriptions WHERE user_id = ?', (user_id,))
+    conn.commit()
+
+def _subscription(conn, user_id):
+    row = conn.execute('SELECT period FROM digest_subscriptions WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else None
+
+def _subscribers(conn, period, cycle, after, limit):
+    return [user_id for (user_id,) in conn.execute('''
+        SELECT user_id FROM digest_subscriptions
+        WHERE period = ? AND (? IS NULL OR user_id > ?) AND sent_cycle IS NOT ?
+        ORDER BY user_id LIMIT ?
+    ''', (period, after, after, cycle, limit))]
+
+def _mark_sent(conn, user_id, cycle):
+    conn.execute('UPDATE digest_subscriptions SET sent_cycle = ? WHERE user_id = ?', (cycle, user_id))
+    conn.commit()
+
+def _subscriber_assets(conn, period):
+    return conn.execute('''
+        SELECT DISTINCT p.asset_name, p.asset_type
+        FROM digest_subscriptions d JOIN portfolio p ON p.user_id = d.user_id
+        WHERE d.period = ?
+    ''', (period,)).fetchall()
+
+# Аренда цикла одним запросом: новый цикл, незавершённый цикл этой же реплики
+# или цикл, аренда которого истекла. Возвращает (last_user_id,) или None, если цикл занят или завершён.
+def _claim_run(conn, period, cycle, owner, now, lease):
+    with conn:
+        cursor = conn.execute('''
+            INSERT INTO digest_runs (period, cycle, last_user_id, finished, owner, lease_until)
+            VALUES (?, ?, NULL, 0, ?, ?)
+            ON CONFLICT (period) DO UPDATE SET
+                last_user_id = CASE WHEN digest_runs.cycle = excluded.cycle THEN digest_runs.last_user_id END,
+                cycle = excluded.cycle, finished = 0, owner = excluded.owner, lease_until = excluded.lease_until
+            WHERE digest_runs.cycle < excluded.cycle
+               OR (digest_runs.cycle = excluded.cycle AND NOT digest_runs.finished
+                   AND (digest_runs.owner IS NULL OR digest_runs.owner = excluded.owner OR digest_runs.lease_until < ?))
+        ''', (period, cycle, owner, now + lease, now))
+        if cursor.rowcount == 0:
+            return None
+        return conn.execute('SELECT last_user_id FROM digest_runs WHERE period = ?', (period,)).fetchone()
+
+# Контрольная точка продлевает аренду; False - цикл уже ведёт другая реплика
+def _save_run(conn, period, cycle, owner, last_user_id, finished, lease_until):
+    cursor = conn.execute('''
+        UPDATE digest_runs SET last_user_id = ?, finished = ?, lease_until = ?
+        WHERE period = ? AND cycle = ? AND owner = ?
+    ''', (last_user_id, int(finished), lease_until, period, cycle, owner))
+    conn.commit()
+    return cursor.rowcount > 0
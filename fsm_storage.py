@@ -0,0 +1,184 @@
+import asyncio
+import copy
+import json
+import time
+import typing
+from aiogram.dispatcher.storage import BaseStorage
+
+# Хранилище состояний FSM в SQLite вместо MemoryStorage.
+# Состояния переживают перезапуск и доступны нескольким процессам бота: запись сквозная,
+# изменение возвращается из set_state/set_data только после записи в базу, поэтому
+# следующее обновление, пришедшее в другую реплику, видит новое состояние. Пока идёт
+# одна запись, изменения других диалогов копятся и уходят следующей пачкой одной
+# транзакцией. Брошенные пользователями диалоги удаляются по истечении ttl.
+class SQLiteStorage(BaseStorage):
+    def __init__(self, db, ttl=86400, evict_interval=600):
+        self.db = db
+        self.ttl = ttl  # через сколько секунд без изменений состояние считается брошенным
+        self.evict_interval = evict_interval
+        self._pending = {}  # {(chat, user): запись}, ждущие следующей пачки
+        self._writer = None  # задача, записывающая пачки, пока в _pending что-то есть
+        self._evicted_at = 0.0
+        db.call(_create_tables)
+
+    async def close(self):
+        await self.wait_closed()
+        await self.flush()
+
+    async def wait_closed(self):
+        if self._writer is not None:
+            try:
+                await self._writer
+            finally:
+                self._writer = None
+
+    def resolve_address(self, chat, user):
+        return tuple(map(str, self.check_address(chat=chat, user=user)))
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        record = await self._get(self.resolve_address(chat, user))
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[str] = None) -> typing.Dict:
+        record = await self._get(self.resolve_address(chat, user))
+        return record['data']
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key = self.resolve_address(chat, user)
+        record = await self._get(key)
+        record['data'].update(data or {}, **kwargs)
+        await self._put(key, record)
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key = self.resolve_address(chat, user)
+        record = await self._get(key)
+        record['state'] = self.resolve_state(state)
+        await self._put(key, record)
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key = self.resolve_address(chat, user)
+        record = await self._get(key)
+        record['data'] = copy.deepcopy(data or {})
+        await self._put(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self._get(self.resolve_address(chat, user))
+        return record['bucket']
+
+    async def set_bucket(self, *,
+                         chat: typing.Union[str, int, None] = None,
+                         user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        key = self.resolve_address(chat, user)
+        record = await self._get(key)
+        record['bucket'] = copy.deepcopy(bucket or {})
+        await self._put(key, record)
+
+    async def update_bucket(self, *,
+                            chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        key = self.resolve_address(chat, user)
+        record = await self._get(key)
+        record['bucket'].update(bucket or {}, **kwargs)
+        await self._put(key, record)
+
+    # Сбрасывает накопленные изменения в базу одной транзакцией
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        now = time.time()
+        evict_before = None
+        if now - self._evicted_at >= self.evict_interval:
+            evict_before = now - self.ttl
+            self._evicted_at = now
+        await self.db.run(_write_batch, batch, evict_before)
+
+    async def _get(self, key):
+        # Незаписанные изменения новее, чем строка в базе. Уже отправленная на запись
+        # пачка видна чтению, потому что поток базы выполняет запросы по очереди
+        if key in self._pending:
+            return copy.deepcopy(self._pending[key])
+        row = await self.db.run(_read, key[0], key[1], time.time() - self.ttl)
+        if row is None:
+            return {'state': None, 'data': {}, 'bucket': {}}
+        return {'state': row[0], 'data': json.loads(row[1]), 'bucket': json.loads(row[2])}
+
+    async def _put(self, key, record):
+        record['updated_at'] = time.time()
+        self._pending[key] = record
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write_pending())
+        # shield: отмена одного обработчика не отменяет запись пачки с чужими изменениями
+        await asyncio.shield(self._writer)
+
+    async def _write_pending(self):
+        while self._pending:
+            await self.flush()
+
+
+def _create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS fsm_state (
+        chat TEXT,
+        user TEXT,
+        state TEXT,
+        data TEXT,
+        bucket TEXT,
+        updated_at REAL,
+        PRIMARY KEY (chat, user)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS fsm_state_updated_at ON fsm_state (updated_at)')
+    conn.commit()
+
+def _read(conn, chat, user, fresh_after):
+    return conn.execute(
+        'SELECT state, data, bucket FROM fsm_state WHERE chat = ? AND user = ? AND updated_at >= ?',
+        (chat, user, fresh_after),
+    ).fetchone()
+
+def _write_batch(conn, batch, evict_before):
+    # Пустые записи (закончившийся диалог) удаляются, остальные перезаписываются целиком
+    empty = [key for key, record in batch.items() if _is_empty(record)]
+    rows = [
+        (chat, user, record['state'], json.dumps(record['data']), json.dumps(record['bucket']), record['updated_at'])
+        for (chat, user), record in batch.items() if not _is_empty(record)
+    ]
+    with conn:
+        if empty:
+            conn.executemany('DELETE FROM fsm_state WHERE chat = ? AND user = ?', empty)
+        if rows:
+            conn.executemany('''
+                INSERT INTO fsm_state (chat, user, state, data, bucket, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (chat, user) DO UPDATE SET
+                    state = excluded.state, data = excluded.data,
+                    bucket = excluded.bucket, updated_at = excluded.updated_at
+            ''', rows)
+        if evict_before is not None:
+            conn.execute('DELETE FROM fsm_state WHERE updated_at < ?', (evict_before,))
+
+def _is_empty(record):
+    return record['state'] is None and not record['data'] and not record['bucket']
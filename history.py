@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import time
+from itertools import groupby
+from background import BackgroundService
+
+log = logging.getLogger(__name__)
+
+# Уровни хранения: (шаг в секундах, срок хранения в секундах или None - бессрочно).
+# Точки мелкого уровня прореживаются в следующий уровень (последняя цена интервала),
+# а затем удаляются по истечении срока хранения.
+TIERS = ((300, 2 * 86400), (3600, 35 * 86400), (86400, None))
+
+# Периоды отчёта: (длина периода, шаг точек)
+PERIODS = {
+    '1d': (86400, 300),
+    '7d': (7 * 86400, 3600),
+    '30d': (30 * 86400, 3600),
+}
+
+# Хранилище истории цен в SQLite. Точки лежат в таблице WITHOUT ROWID с ключом
+# (resolution, symbol_id, ts), поэтому ряд одного символа хранится подряд и
+# выборка диапазона - это один проход по B-дереву.
+class PriceHistory:
+    def __init__(self, db, tiers=TIERS):
+        self.db = db
+        self.tiers = tiers
+        self._symbol_ids = {}  # {(asset_type, asset_name): id}, заполняется в потоке базы
+        db.call(_create_tables)
+
+    # Дописывает пачку цен {(asset_type, asset_name): цена} одной транзакцией
+    async def append(self, prices, ts=None):
+        if not prices:
+            return
+        step = self.tiers[0][0]
+        ts = int(ts if ts is not None else time.time()) // step * step
+        await self.db.run(self._append, prices, ts, step)
+
+    async def series(self, symbols, since, until, resolution):
+        return await self.db.run(self._series, list(symbols), int(since), int(until), resolution)
+
+    # Стоимость портфеля за период по сохранённым ценам, без запросов к поставщикам.
+    # holdings - строки (asset_name, amount, asset_type); результат - ([(ts, стоимость)], [активы без истории]).
+    # Активы без единой точки за период в стоимость не входят и возвращаются отдельно.
+    async def portfolio_value(self, holdings, period, now=None):
+        length, resolution = PERIODS[period]
+        until = int(now if now is not None else time.time())
+        amounts = {}
+        for asset_name, amount, asset_type in holdings:
+            amounts[(asset_type, asset_name)] = amounts.get((asset_type, asset_name), 0) + amount
+        series = await self.series(amounts, until - length, until, resolution)
+        points = sorted((ts, key, price) for key, rows in series.items() for ts, price in rows)
+        # Стоимость считается с момента, когда известны цены всех активов, цены между точками переносятся вперёд
+        last = {}
+        values = []
+        for ts, group in groupby(points, key=lambda point: point[0]):
+            for _, key, price in group:
+                last[key] = price
+            if len(last) == len(series):
+                values.append((ts, sum(amounts[key] * price for key, price in last.items())))
+        return values, sorted(key for key in amounts if key not in series)
+
+    # Прореживание и удаление устаревших точек
+    async def compact(self, now=None):
+        await self.db.run(self._compact, int(now if now is not None else time.time()))
+
+    def _symbol_id(self, conn, key):
+        symbol_id = self._symbol_ids.get(key)
+        if symbol_id is None:
+            conn.execute('INSERT OR IGNORE INTO price_symbols (asset_type, asset_name) VALUES (?, ?)', key)
+            symbol_id = conn.execute(
+                'SELECT id FROM price_symbols WHERE asset_type = ? AND asset_name = ?', key
+            ).fetchone()[0]
+            self._symbol_ids[key] = symbol_id
+        return symbol_id
+
+    def _append(self, conn, prices, ts, step):
+        with conn:
+            rows = [(step, self._symbol_id(conn, key), ts, price) for key, price in prices.items()]
+            conn.executemany(
+                'INSERT OR REPLACE INTO price_history (resolution, symbol_id, ts, price) VALUES (?, ?, ?, ?)', rows
+            )
+
+    def _series(self, conn, symbols, since, until, resolution):
+        result = {}
+        for key in symbols:
+            row = conn.execute(
+                'SELECT id FROM price_symbols WHERE asset_type = ? AND asset_name = ?', key
+            ).fetchone()
+            if row is None:
+                continue
+            rows = conn.execute('''
+                SELECT ts, price FROM price_history
+                WHERE resolution = ? AND symbol_id = ? AND ts >= ? AND ts <= ?
+                ORDER BY ts
+            ''', (resolution, row[0], since, until)).fetchall()
+            if rows:
+                result[key] = rows
+        return result
+
+    def _compact(self, conn, now):
+        with conn:
+            for (source, retention), (target, _) in zip(self.tiers, self.tiers[1:]):
+                row = conn.execute(
+                    'SELECT compacted_until FROM price_history_meta WHERE resolution = ?', (target,)
+                ).fetchone()
+                since = row[0] if row else 0
+                # Прореживаем только завершённые интервалы целевого уровня
+                until = now // target * target
+                if until > since:
+                    conn.execute('''
+                        INSERT OR REPLACE INTO price_history (resolution, symbol_id, ts, price)
+                        SELECT ?, symbol_id, bucket, price FROM (
+                            SELECT symbol_id, ts / ? * ? AS bucket, price, MAX(ts)
+                            FROM price_history
+                            WHERE resolution = ? AND ts >= ? AND ts < ?
+                            GROUP BY symbol_id, bucket
+                        )
+                    ''', (target, target, target, source, since, until))
+                    conn.execute('''
+                        INSERT INTO price_history_meta (resolution, compacted_until) VALUES (?, ?)
+                        ON CONFLICT (resolution) DO UPDATE SET compacted_until = excluded.compacted_until
+                    ''', (target, until))
+            for resolution, retention in self.tiers:
+                if retention is not None:
+                    conn.execute(
+                        'DELETE FROM price_history WHERE resolution = ? AND ts < ?', (resolution, now - retention)
+                    )
+
+# Фоновая запись снимков: раз в интервал одна пакетная оценка всех активов из портфелей
+class HistoryRecorder(BackgroundService):
+    def __init__(self, history: PriceHistory, db, valuer, compact_every=3600):
+        self.history = history
+        self.db = db
+        self.valuer = valuer
+        self.compact_every = compact_every
+
+    async def snapshot(self):
+        assets = await self.db.distinct_assets()
+        if not assets:
+            return
+        prices = await self.valuer.price(assets)
+        await self.history.append({key: price for key, price in prices.items() if isinstance(price, float)})
+
+    async def _run(self):
+        step = self.history.tiers[0][0]
+        compacted_at = 0
+        while True:
+            try:
+                await self.snapshot()
+                if time.time() - compacted_at >= self.compact_every:
+                    await self.history.compact()
+                    compacted_at = time.time()
+            except Exception:
+                log.exception("Price history snapshot failed")
+            # Снимки выравниваются по границе интервала
+            await asyncio.sleep(step - time.time() % step)
+
+
+def _create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS price_symbols (
+        id INTEGER PRIMARY KEY,
+        asset_type TEXT,
+        asset_name TEXT,
+        UNIQUE (asset_type, asset_name)
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS price_history (
+        resolution INTEGER,
+        symbol_id INTEGER,
+        ts INTEGER,
+        price REAL,
+        PRIMARY KEY (resolution, symbol_id, ts)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS price_history_meta (
+        resolution INTEGER PRIMARY KEY,
+        compacted_until INTEGER
+    )
+    ''')
+    conn.commit()
@@ -1,53 +1,190 @@
-import sqlite3
-import requests
+import math
 import os
+import tempfile
 from dotenv import load_dotenv
 from datetime import datetime
-from binance.client import Client
 from aiogram import Bot, Dispatcher, types, executor
-from aiogram.types import ParseMode, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+from aiogram.types import ParseMode, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle, InputTextMessageContent
 from aiogram.utils import executor
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import Command, Text
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from rates_cache import RatesCache
+from providers import ProviderError, HttpClient, CbrClient, BinanceClient, AlphaVantageClient
+from policy import ProviderPolicy, GuardedClient
+from valuation import Valuer
+from binance_stream import PriceTable, BinanceStream
+from stock_quotes import StockQuotes
+from symbols import SymbolIndex, SymbolLoader
+from storage import Database
+from fsm_storage import SQLiteStorage
+from webhook import run_webhook
+from alerts import AlertEngine, ABOVE, BELOW
+from history import PERIODS, PriceHistory, HistoryRecorder
+from crossrates import PRICE_UNITS, PortfolioValuation
+from digest import PERIODS as DIGEST_PERIODS, DigestBroadcaster
+import metrics
+import portfolio_io
+from portfolio_io import PortfolioFileError
+
+# Сервисы создаются лениво в init_services(): импорт модуля не читает .env,
+# не открывает базу данных и не обращается к сети
+http = None
+cbr = None
+binance = None
+alpha_vantage = None
+currency_rates = None
+db = None
+stock_quotes = None
+symbol_loader = None
+binance_stream = None
+valuer = None
+background_valuer = None
+alert_engine = None
+price_history = None
+history_recorder = None
+portfolio_valuation = None
+digest = None
+metrics_server = None
+profiler = None
+
+# Локальный индекс тикеров: проверка ввода и подсказки без обращения к поставщикам
+symbol_index = SymbolIndex()
+# Таблица котировок из потока Binance
+price_table = PriceTable()
+
+def init_services():
+    global http, cbr, binance, alpha_vantage, currency_rates, db, stock_quotes, symbol_loader, binance_stream, valuer, alert_engine, \
+        price_history, history_recorder, portfolio_valuation, digest, profiler, background_valuer
+    if db is not None:
+        return
+    load_dotenv()
+
+    # Асинхронные клиенты поставщиков цен с общим пулом соединений
+    http = HttpClient()
+    # Запросы цен идут через политику поставщика: дедлайн, хеджирование после p95,
+    # автомат размыкания с последней удачной ценой и резервный адрес *_FALLBACK_URL, если задан
+    cbr = GuardedClient(
+        CbrClient(http, os.getenv('CBR_URL')),
+        ProviderPolicy('ЦБ РФ', deadline=float(os.getenv('CBR_DEADLINE', 5))),
+        ['daily'],
+        fallback=CbrClient(http, os.getenv('CBR_FALLBACK_URL')) if os.getenv('CBR_FALLBACK_URL') else None,
+    )
+    binance = GuardedClient(
+        BinanceClient(http, os.getenv('BINANCE_URL')),
+        ProviderPolicy('Binance', deadline=float(os.getenv('BINANCE_DEADLINE', 3))),
+        ['ticker_price', 'ticker_prices'],
+        fallback=BinanceClient(http, os.getenv('BINANCE_FALLBACK_URL')) if os.getenv('BINANCE_FALLBACK_URL') else None,
+    )
+    # Каждый запрос к Alpha Vantage расходует квоту, поэтому без хеджирования. Последнюю удачную
+    # котировку хранит таблица stock_quotes, поэтому политика её не отдаёт: иначе старая цена
+    # была бы сохранена как свежая
+    alpha_vantage = GuardedClient(
+        AlphaVantageClient(http, os.getenv('AV_API_KEY'), os.getenv('ALPHAVANTAGE_URL')),
+        ProviderPolicy('Alpha Vantage', deadline=float(os.getenv('AV_DEADLINE', 10)), hedge=False, stale_ttl=0),
+        ['query'],
+    )
 
-load_dotenv()
-api_token = os.getenv('API_TOKEN')
-bot = Bot(token=api_token)
+    # Лента скачивается один раз и раздаётся всем обработчикам из памяти
+    currency_rates = RatesCache(lambda: cbr.daily())
 
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
+    # Подключаемся к базе данных SQLite (запросы выполняются вне цикла событий)
+    db = Database(os.getenv('DATABASE_PATH', './app_data/database.db'))
+    # Создаем таблицы и индексы, если они не существуют
+    db.create_tables()
 
-AV_API = os.getenv('AV_API_KEY')
-BINANCE_API_KEY = os.getenv('BINANCE_API_KEY')
-BINANCE_API_SECRET = os.getenv('BINANCE_API_SECRET')
+    # Котировки акций с учётом квоты Alpha Vantage (бесплатный тариф: 5 запросов в минуту, 25 в сутки)
+    stock_quotes = StockQuotes(
+        db,
+        alpha_vantage,
+        per_minute=int(os.getenv('AV_PER_MINUTE', 5)),
+        per_day=int(os.getenv('AV_PER_DAY', 25)),
+    )
 
-# Инициализация Binance API клиента
-client = Client(BINANCE_API_KEY, BINANCE_API_SECRET)
+    symbol_loader = SymbolLoader(symbol_index, {
+        'crypto': (binance.usdt_assets, 3600),
+        'currency': (load_currency_symbols, 3600),
+        'stock': (load_stock_symbols, 86400),
+    })
+
+    # Потоковый режим котировок Binance включается переменной окружения BINANCE_STREAM=1
+    price_table.max_age = float(os.getenv('BINANCE_STREAM_MAX_AGE', 30))
+    if os.getenv('BINANCE_STREAM') == '1':
+        binance_stream = BinanceStream(http, price_table, portfolio_crypto_symbols, os.getenv('BINANCE_WS_URL'))
+
+    # Оценка портфеля пакетными запросами к поставщикам
+    valuer = Valuer(currency_rates, binance, get_stock_rate, stream=binance_stream)
+    # Стоимость портфелей в базовой валюте пользователя через матрицу кросс-курсов
+    portfolio_valuation = PortfolioValuation(db, valuer, currency_rates)
+    # Фоновые задачи берут акции только из кэша: квоты Alpha Vantage (25 в сутки)
+    # не хватит даже на снимки истории раз в 5 минут, она остаётся пользователям
+    background_valuer = Valuer(currency_rates, binance, get_cached_stock_rate, stream=binance_stream)
+
+    # Метрики: доли попаданий в кэши и состояние политик поставщиков читаются при запросе /metrics
+    metrics.register_cache('cbr_rates', currency_rates)
+    metrics.register_cache('stock_quotes', stock_quotes)
+    metrics.register_cache('binance_stream', price_table)
+    for client in (cbr, binance, alpha_vantage):
+        metrics.register_policy(client.policy)
+    # Семплирующий профилировщик включается на лету через /debug/profiler/start, если PROFILER=1
+    if os.getenv('PROFILER') == '1':
+        profiler = metrics.SamplingProfiler(interval=float(os.getenv('PROFILER_INTERVAL', 0.005)))
+
+    # Алерты проверяются раз в ALERT_INTERVAL секунд, а при включённом потоке - на каждый тик
+    alert_engine = AlertEngine(db, background_valuer, send_alert, interval=int(os.getenv('ALERT_INTERVAL', 60)))
+    if binance_stream is not None:
+        binance_stream.listeners.append(alert_engine.on_tick)
+
+    # История цен: снимок всех активов из портфелей раз в 5 минут, с прореживанием старых точек
+    price_history = PriceHistory(db)
+    history_recorder = HistoryRecorder(price_history, db, background_valuer)
+
+    # Сводки по подпискам /digest: один снимок цен на цикл и не больше 30 сообщений в секунду
+    digest = DigestBroadcaster(
+        db, PortfolioValuation(db, background_valuer, currency_rates), send_digest,
+        daily_hour=int(os.getenv('DIGEST_HOUR', 9)),
+    )
 
-# Подключаемся к базе данных SQLite
-conn = sqlite3.connect('./app_data/database.db')
-cursor = conn.cursor()
+# Фабрика приложения: создаёт сервисы, бота и диспетчер с зарегистрированными обработчиками
+def create_app():
+    init_services()
+    # TELEGRAM_API_URL - локальный Bot API сервер или заглушка для нагрузочных тестов
+    server = TelegramAPIServer.from_base(os.getenv('TELEGRAM_API_URL')) if os.getenv('TELEGRAM_API_URL') else TELEGRAM_PRODUCTION
+    # Бот с замером запросов к Bot API, обработчики замеряются middleware
+    bot = metrics.MetricsBot(token=os.getenv('API_TOKEN'), server=server)
+    # Состояния диалогов хранятся в SQLite: переживают перезапуск и удаляются через FSM_TTL секунд бездействия
+    storage = SQLiteStorage(db, ttl=int(os.getenv('FSM_TTL', 86400)))
+    dp = Dispatcher(bot, storage=storage)
+    register_handlers(dp)
+    metrics.instrument(dp)
+    return dp
+
+async def load_currency_symbols():
+    return list((await currency_rates.get())['Valute'])
+
+async def load_stock_symbols():
+    # LISTING_STATUS расходует запрос из квоты Alpha Vantage, поэтому ждать слот не будем
+    if await stock_quotes.budget.delay() != 0:
+        raise ProviderError("Нет свободного запроса к Alpha Vantage")
+    await stock_quotes.budget.spend()
+    return await alpha_vantage.listed_symbols()
+
+# Криптовалютные пары из всех портфелей и алертов - на них держится подписка потока Binance
+async def portfolio_crypto_symbols():
+    return {f"{asset_name}USDT" for asset_name in await db.asset_names('crypto')} | alert_engine.crypto_pairs()
+
+# Уведомление пользователя о сработавшем алерте
+async def send_alert(alert, price):
+    direction = 'выше' if alert.direction == ABOVE else 'ниже'
+    await Bot.get_current().send_message(
+        alert.user_id,
+        f"🔔 {alert.asset_name}: цена {price:.2f} {direction} порога {alert.threshold} (алерт #{alert.id})"
+    )
 
-# Создаем таблицы, если они не существуют
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    user_id INTEGER PRIMARY KEY,
-    username TEXT
-)
-''')
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS portfolio (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    asset_name TEXT,
-    amount REAL,
-    asset_type TEXT, -- 'currency', 'crypto', 'stock'
-    FOREIGN KEY (user_id) REFERENCES users (user_id)
-)
-''')
-conn.commit()
+# Отправка сводки подписчику
+async def send_digest(chat_id, text):
+    await Bot.get_current().send_message(chat_id, text)
 
 # Создаем клавиатуру с кнопками
 def main_menu_keyboard():
@@ -73,6 +210,13 @@ def asset_type_inline_keyboard():
     )
     return inline_kb
 
+# Inline-клавиатура с подсказками тикеров и кнопкой поиска через inline-режим
+def ticker_suggestions_keyboard(tickers):
+    inline_kb = InlineKeyboardMarkup(row_width=4)
+    inline_kb.add(*(InlineKeyboardButton(ticker, callback_data=f'ticker:{ticker}') for ticker in tickers))
+    inline_kb.row(InlineKeyboardButton("🔎 Поиск тикера", switch_inline_query_current_chat=''))
+    return inline_kb
+
 # Определение состояний
 class CurrencyState(StatesGroup):
     waiting_for_asset = State()
@@ -87,7 +231,6 @@ class Portfolio(StatesGroup):
     waiting_for_amount = State() 
 
 # Обработка нажатий на Inline-кнопки для выбора актива
-@dp.callback_query_handler(lambda c: c.data in ['crypto', 'currency', 'stock'], state=Portfolio.waiting_for_asset_type)
 async def process_asset_choice(callback_query: types.CallbackQuery, state: FSMContext):
     asset_type = callback_query.data
     await state.update_data(asset_type=asset_type)
@@ -96,70 +239,74 @@ async def process_asset_choice(callback_query: types.CallbackQuery, state: FSMCo
     await Portfolio.waiting_for_asset_ticker.set()
 
 # Функция для получения курса валюты
-def get_currency_rate(currency: str):
-    response = requests.get('https://www.cbr-xml-daily.ru/daily_json.js')
-    return response.json()['Valute']
+@metrics.timed_rate
+async def get_currency_rate(currency: str):
+    return (await currency_rates.get())['Valute']
 
 # Функция для получения курса криптовалюты
-def get_crypto_rate(crypto: str):
+@metrics.timed_rate
+async def get_crypto_rate(crypto: str):
     crypto = crypto+'USDT'
+    # При включённом потоке свежая цена берётся из памяти без запроса к REST API
+    if binance_stream is not None:
+        price = binance_stream.quote(crypto)
+        if price is not None:
+            return price
     try:
-        response = client.get_symbol_ticker(symbol=crypto)
+        response = await binance.ticker_price(crypto)
         # Извлекаем цену из ответа
         price = response.get('price')
         if price:
             return float(price)  # Преобразуем строку в число с плавающей запятой
         else:
             return "Криптовалюта не найдена."
-    except Exception as e:
-        return str(e)
+    except ProviderError as e:
+        return f"Ошибка: {e}"
     
 # Функция для получения курса акций
-def get_stock_rate(stock: str):
+@metrics.timed_rate
+async def get_stock_rate(stock: str):
     try:
-        # Используем API, например, Alpha Vantage
-        response = requests.get(f'https://www.alphavantage.co/query?function=TIME_SERIES_DAILY&symbol={stock}&apikey=P{AV_API}')
-        data = response.json()
-        # Проверяем, что в ответе есть нужные данные
-        if "Time Series (Daily)" in data:
-            time_series = data['Time Series (Daily)']
-            # Получаем последнюю временную метку (это будет самая актуальная цена)
-            latest_time = sorted(time_series.keys(), reverse=True)[0]
-            # Извлекаем цену открытия для этой метки
-            return time_series[latest_time]['4. close']
-        else:
-            return "Ошибка: данные не содержат 'Time Series (Daily)'"
-    except Exception as e:
-        return str(e)
+        # Котировка из кэша stock_quotes или запрос GLOBAL_QUOTE к Alpha Vantage в рамках квоты
+        quote = await stock_quotes.quote(stock)
+        return quote.price
+    except ProviderError as e:
+        return f"Ошибка: {e}"
+
+# Цена акции из кэша stock_quotes без расхода квоты - для фоновых задач.
+# Устаревшая котировка считается отсутствующей: по ней нельзя срабатывать алертам и писать историю.
+async def get_cached_stock_rate(stock: str):
+    try:
+        quote = await stock_quotes.cached(stock)
+    except ProviderError as e:
+        return f"Ошибка: {e}"
+    if quote.stale:
+        return f"Ошибка: котировка {stock} устарела"
+    return quote.price
 
 # Команда для старта
-@dp.message_handler(commands=['start'])
 async def start(message: types.Message):
     user_id = message.from_user.id
     username = message.from_user.username
-    cursor.execute('INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)', (user_id, username))
-    conn.commit()
+    await db.add_user(user_id, username)
     await message.reply(
         "Добро пожаловать! Я помогу вам отслеживать курсы валют, криптовалют и акций.",
         reply_markup=main_menu_keyboard()  # Отправляем клавиатуру при старте
     )
 
 # Команда /help для справки
-@dp.message_handler(commands=['help'])
 async def help_command(message: types.Message):
     help_text = ('Добро пожаловать! Я помогу вам отслеживать курсы валют, криптовалют и акций.')
     await message.reply(help_text, reply_markup=main_menu_keyboard())  # Отправляем клавиатуру с командой /help
 
 # Команда для получения курса валюты
-@dp.message_handler(Text(equals="💵Валюта", ignore_case=True))
 async def currency_command(message: types.Message):
     await message.reply("Введите тикер валюты (например, USD, EUR, CNY):")
     await CurrencyState.waiting_for_asset.set()  # Устанавливаем состояние ожидания ввода тикера
 
-@dp.message_handler(state=CurrencyState.waiting_for_asset)
-async def crypto_command(message: types.Message, state: FSMContext):
+async def currency_rate_command(message: types.Message, state: FSMContext):
     ticker = message.text.strip().upper()
-    rates = get_currency_rate(ticker)
+    rates = await get_currency_rate(ticker)
     if ticker in rates:
         value = rates[ticker]['Value']
         name = rates[ticker]['Name']
@@ -171,17 +318,15 @@ async def crypto_command(message: types.Message, state: FSMContext):
     await state.finish()  # Завершение состояния
 
 # Команда для получения курса криптовалюты
-@dp.message_handler(Text(equals="💸Крипто", ignore_case=True))
 async def start_crypto_process(message: types.Message, state: FSMContext):
     await message.reply("Пожалуйста, введите тикер актива, например: btc, eth")
     await PriceState.waiting_for_asset.set()  # Устанавливаем состояние ожидания ввода тикера
 
 # Обрабатываем ввод тикера от пользователя
-@dp.message_handler(state=PriceState.waiting_for_asset)
 async def crypto_command(message: types.Message, state: FSMContext):
     # Получаем тикер из текста сообщения
     crypto = message.text.strip().upper()
-    rate = get_crypto_rate(crypto)  # Предполагается, что эта функция возвращает курс
+    rate = await get_crypto_rate(crypto)  # Предполагается, что эта функция возвращает курс
     if isinstance(rate, float):
         await message.reply(f"Курс {crypto.upper()}: {rate}")
     else:
@@ -189,15 +334,13 @@ async def crypto_command(message: types.Message, state: FSMContext):
     await state.finish()  # Завершаем состояние после обработки тикера
 
 # Команда для получения курса акций
-@dp.message_handler(Text(equals="📈Акции", ignore_case=True))
 async def start_price_process(message: types.Message, state: FSMContext):
     await message.reply("Пожалуйста, введите тикер актива, например: ibm")
     await StockState.waiting_for_asset.set()  # Устанавливаем состояние ожидания ввода тикера
 
-@dp.message_handler(state=StockState.waiting_for_asset)
 async def stock_command(message: types.Message, state: FSMContext):
     stock = message.text.strip().upper()
-    rate = get_stock_rate(stock)
+    rate = await get_stock_rate(stock)
     if rate:
         await message.reply(f"Курс акции {stock}: {rate} USD")
     else:
@@ -205,14 +348,12 @@ async def stock_command(message: types.Message, state: FSMContext):
     await state.finish()  # Завершаем состояние после обработки тикера
 
 # Команда для добавления актива в портфолио
-@dp.message_handler(Text(equals="Добавить актив", ignore_case=True))
 async def add_to_portfolio(message: types.Message, state: FSMContext):
     await state.set_state(Portfolio.waiting_for_asset_type)
     await message.answer("Выберите тип актива для добавления:", reply_markup=asset_type_inline_keyboard())
     # await Portfolio.waiting_for_asset_type.set()  # Устанавливаем состояние ожидания выбора типа актива
 
 # Обрабатываем выбор типа актива
-@dp.message_handler(Text(equals=["Крипто", "💵Валюта", "Акции"], ignore_case=True), state=Portfolio.waiting_for_asset_type)
 async def process_asset_type(message: types.Message, state: FSMContext):
     asset_type = message.text.lower()
     await state.update_data(asset_type=asset_type)  # Сохраняем тип актива
@@ -220,15 +361,47 @@ async def process_asset_type(message: types.Message, state: FSMContext):
     await state.set_state(Portfolio.waiting_for_asset_ticker)  # Переходим к следующему состоянию для ввода тикера
 
 # Обрабатываем ввод тикера
-@dp.message_handler(state=Portfolio.waiting_for_asset_ticker)
 async def process_asset_ticker(message: types.Message, state: FSMContext):
-    asset_ticker = message.text.upper()
+    asset_ticker = message.text.strip().upper()
+    user_data = await state.get_data()
+    asset_type = user_data.get('asset_type')
+    # Опечатка в тикере выявляется по локальному индексу без сетевого запроса
+    if symbol_index.contains(asset_type, asset_ticker) is False:
+        suggestions = symbol_index.prefix(asset_type, asset_ticker[:-1] or asset_ticker, limit=8)
+        if suggestions:
+            await message.reply(f"Тикер {asset_ticker} не найден. Возможно, вы имели в виду:", reply_markup=ticker_suggestions_keyboard(suggestions))
+        else:
+            await message.reply(f"Тикер {asset_ticker} не найден. Попробуйте снова.", reply_markup=ticker_suggestions_keyboard([]))
+        return  # Остаёмся в состоянии ввода тикера
     await state.update_data(asset_ticker=asset_ticker)  # Сохраняем тикер актива
     await message.reply(f"Вы выбрали {asset_ticker}. Пожалуйста, введите количество, например: 10.5")
     await Portfolio.waiting_for_amount.set()  # Переходим к следующему состоянию для ввода количества
 
+# Выбор тикера из подсказок
+async def process_ticker_suggestion(callback_query: types.CallbackQuery, state: FSMContext):
+    asset_ticker = callback_query.data.split(':', 1)[1]
+    await state.update_data(asset_ticker=asset_ticker)
+    await callback_query.message.answer(f"Вы выбрали {asset_ticker}. Пожалуйста, введите количество, например: 10.5")
+    await callback_query.answer()
+    await Portfolio.waiting_for_amount.set()
+
+# Inline-режим: автодополнение тикеров по префиксу; тип актива берётся из текущего шага добавления
+async def inline_ticker_search(inline_query: types.InlineQuery, state: FSMContext):
+    prefix = inline_query.query.strip().upper()
+    user_data = await state.get_data()
+    asset_types = [user_data['asset_type']] if user_data.get('asset_type') in ('crypto', 'currency', 'stock') else ['crypto', 'currency', 'stock']
+    results = []
+    for asset_type in asset_types:
+        for ticker in symbol_index.prefix(asset_type, prefix, limit=20):
+            results.append(InlineQueryResultArticle(
+                id=f'{asset_type}:{ticker}',
+                title=ticker,
+                description=asset_type,
+                input_message_content=InputTextMessageContent(ticker),
+            ))
+    await inline_query.answer(results[:50], cache_time=60, is_personal=True)
+
 # Обрабатываем ввод количества
-@dp.message_handler(state=Portfolio.waiting_for_amount)
 async def process_asset_amount(message: types.Message, state: FSMContext):
     try:
         amount = float(message.text)
@@ -237,27 +410,30 @@ async def process_asset_amount(message: types.Message, state: FSMContext):
         asset_ticker = user_data['asset_ticker']
         user_id = message.from_user.id
 
-        # Проверка наличия актива
-        asset_exists = False
+        # Проверка наличия актива: сначала по локальному индексу тикеров, без сетевого запроса
+        asset_exists = symbol_index.contains(asset_type, asset_ticker)
         current_price = None
 
-        if asset_type == 'crypto':
-            current_price = get_crypto_rate(asset_ticker)
-            if isinstance(current_price, float):
-                asset_exists = True
-        elif asset_type == 'currency':
-            rates = get_currency_rate(asset_ticker)
-            if asset_ticker in rates:
-                asset_info = rates[asset_ticker]
-                nominal = asset_info['Nominal']
-                current_price = asset_info['Value'] / nominal
-                asset_exists = True
-        elif asset_type == 'stock':
-            current_price = get_stock_rate(asset_ticker)
-            if isinstance(current_price, str) and current_price.startswith("Ошибка"):
-                asset_exists = False
-            else:
-                asset_exists = True
+        # Индекс для этого типа ещё не загружен - проверяем у поставщика
+        if asset_exists is None:
+            asset_exists = False
+            if asset_type == 'crypto':
+                current_price = await get_crypto_rate(asset_ticker)
+                if isinstance(current_price, float):
+                    asset_exists = True
+            elif asset_type == 'currency':
+                rates = await get_currency_rate(asset_ticker)
+                if asset_ticker in rates:
+                    asset_info = rates[asset_ticker]
+                    nominal = asset_info['Nominal']
+                    current_price = asset_info['Value'] / nominal
+                    asset_exists = True
+            elif asset_type == 'stock':
+                current_price = await get_stock_rate(asset_ticker)
+                if isinstance(current_price, str) and current_price.startswith("Ошибка"):
+                    asset_exists = False
+                else:
+                    asset_exists = True
         
         # Если актив не существует, сообщаем об этом пользователю
         if not asset_exists:
@@ -265,30 +441,11 @@ async def process_asset_amount(message: types.Message, state: FSMContext):
             await state.finish()
             return
 
-        # Проверка, существует ли уже запись с таким активом для пользователя
-        cursor.execute('''
-            SELECT amount FROM portfolio
-            WHERE user_id = ? AND asset_name = ? AND asset_type = ?
-        ''', (user_id, asset_ticker, asset_type))
-        result = cursor.fetchone()
-
-        if result:
-            # Если актив уже существует, обновляем количество
-            new_amount = result[0] + amount
-            cursor.execute('''
-                UPDATE portfolio
-                SET amount = ?
-                WHERE user_id = ? AND asset_name = ? AND asset_type = ?
-            ''', (new_amount, user_id, asset_ticker, asset_type))
-            conn.commit()
+        # Добавляем актив или прибавляем количество к существующему одним атомарным UPSERT
+        new_amount = await db.add_asset(user_id, asset_type, asset_ticker, amount)
+        if new_amount != amount:
             await message.reply(f"Количество {asset_ticker} обновлено. Теперь у вас {new_amount}.")
         else:
-            # Если актив не найден, добавляем его как новую запись
-            cursor.execute('''
-                INSERT INTO portfolio (user_id, asset_name, amount, asset_type)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, asset_ticker, amount, asset_type))
-            conn.commit()
             await message.reply(f"{asset_ticker} в количестве {amount} добавлен в ваше портфолио.")
     except ValueError:
         await message.reply("Пожалуйста, введите корректное число для количества.")
@@ -297,53 +454,304 @@ async def process_asset_amount(message: types.Message, state: FSMContext):
     finally:
         await state.finish()  # Завершаем состояние после обработки
 
-# Команда для отображения портфолио с текущими ценами активов
-@dp.message_handler(Text(equals="Портфель", ignore_case=True))
+# Команда для отображения портфолио с текущими ценами активов в базовой валюте пользователя
 async def portfolio_command(message: types.Message):
-    user_id = message.from_user.id
-    cursor.execute('SELECT asset_name, amount, asset_type FROM portfolio WHERE user_id = ?', (user_id,))
-    assets = cursor.fetchall()
+    try:
+        holdings, total, base = await portfolio_valuation.portfolio(message.from_user.id)
+    except Exception as e:
+        await message.reply(f"Ошибка при оценке портфеля: {e}")
+        return
 
-    if assets:
+    if holdings:
         portfolio_info = []
-        for asset_name, amount, asset_type in assets:
-            current_price = None
-            # Получаем текущую цену для криптовалюты
-            if asset_type == 'crypto':
-                try:
-                    current_price = get_crypto_rate(f"{asset_name}")
-                except Exception as e:
-                    current_price = f"Ошибка: {str(e)}"
-            # Получаем текущую цену для валюты
-            elif asset_type == 'currency':
-                rates = get_currency_rate(asset_name)
-                if asset_name in rates:
-                    currency_info = rates[asset_name]
-                    nominal = currency_info['Nominal']
-                    value = currency_info['Value']
-                    current_price = value / nominal  # Цена за единицу валюты
-                else:
-                    current_price = "Ошибка при получении курса"
-            # Получаем текущую цену для акций
-            elif asset_type == 'stock':
-                current_price = get_stock_rate(asset_name)
-                if not current_price:
-                    current_price = "Ошибка при получении цены"
-            # Формируем строку для каждого актива с его текущей ценой
-            if isinstance(current_price, float):
-                total_value = amount * current_price
+        for holding in holdings:
+            # Цена показывается в валюте поставщика, стоимость - в базовой валюте
+            if isinstance(holding.price, float):
                 portfolio_info.append(
-                    f"{asset_name} - Кол-во: {amount}, Цена: {current_price:.2f} USD, Итого: {total_value:.2f} USD"
+                    f"{holding.asset_name} - Кол-во: {holding.amount}, Цена: {holding.price:.2f} {holding.unit}, "
+                    f"Итого: {holding.value:.2f} {base}"
                 )
             else:
                 portfolio_info.append(
-                    f"{asset_name} - Кол-во: {amount}, Цена: {current_price}"
+                    f"{holding.asset_name} - Кол-во: {holding.amount}, Цена: {holding.price}"
                 )
+        portfolio_info.append(f"Всего: {total:.2f} {base}")
         # Отправляем пользователю информацию о его портфолио
         await message.reply(f"Ваше портфолио:\n" + "\n".join(portfolio_info))
     else:
         await message.reply("Ваше портфолио пусто. Добавьте активы.")
 
-# Запуск бота
+# Команда /base: выбор валюты, в которой считается стоимость портфеля
+async def base_command(message: types.Message):
+    currency = message.get_args().strip().upper()
+    if not currency:
+        base = await db.get_base_currency(message.from_user.id)
+        await message.reply(f"Базовая валюта: {base}. Изменить: /base RUB, /base USD, /base USDT, /base EUR...")
+        return
+    rates = await portfolio_valuation.rates()
+    if currency not in rates:
+        await message.reply(f"Валюта {currency} не поддерживается.")
+        return
+    await db.set_base_currency(message.from_user.id, currency)
+    await message.reply(f"Базовая валюта: {currency}.")
+
+IMPORT_USAGE = (
+    "Пришлите файл .csv или .json с колонками asset_type (crypto, currency, stock), asset_name и amount.\n"
+    "Количества из файла заменяют текущие. Выгрузить портфель: /export csv или /export json"
+)
+IMPORT_MAX_BYTES = 5 * 2 ** 20
+
+# Команда /import: подсказка по формату файла
+async def import_command(message: types.Message):
+    await message.reply(IMPORT_USAGE)
+
+# Импорт портфеля из присланного документа: потоковый разбор, пакетная проверка тикеров, одна транзакция
+async def import_document(message: types.Message):
+    document = message.document
+    try:
+        fmt = portfolio_io.file_format(document.file_name)
+        if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+            raise PortfolioFileError(f"Файл больше {IMPORT_MAX_BYTES // 2 ** 20} МБ")
+        with tempfile.TemporaryFile() as file:
+            await document.download(destination_file=file)
+            rows, errors = portfolio_io.parse(file, fmt)
+    except PortfolioFileError as e:
+        await message.reply(f"{e}\n{IMPORT_USAGE}")
+        return
+
+    # Списки тикеров загружаются одним запросом на тип, а не ценой на каждую строку
+    await symbol_loader.ensure({row.asset_type for row in rows})
+    unknown, unchecked = portfolio_io.check_assets(rows, symbol_index)
+    assets = []
+    for row in rows:
+        if (row.asset_type, row.asset_name) in unknown:
+            errors.append(f"{'Строка' if fmt == 'csv' else 'Запись'} {row.line}: тикер {row.asset_name} не найден")
+        else:
+            assets.append((row.asset_type, row.asset_name, row.amount))
+    if assets:
+        await db.add_user(message.from_user.id, message.from_user.username)
+        await db.set_assets(message.from_user.id, assets)
+
+    lines = [f"Импортировано активов: {len(assets)}."]
+    if unchecked:
+        lines.append(f"Без проверки тикера (список тикеров сейчас недоступен): {len(unchecked)}.")
+    if errors:
+        lines.append(f"Пропущено: {len(errors)}.")
+        lines.extend(errors[:10])
+        if len(errors) > 10:
+            lines.append("...")
+    await message.reply("\n".join(lines))
+
+# Команда /export: выгрузка портфеля файлом; строки пишутся из базы во временный файл порциями
+async def export_command(message: types.Message):
+    fmt = message.get_args().strip().lower() or 'csv'
+    if fmt not in portfolio_io.FORMATS:
+        await message.reply("Формат: /export [csv|json]")
+        return
+    with tempfile.NamedTemporaryFile('w+', suffix=f'.{fmt}', encoding='utf-8', newline='') as file:
+        count = await db.run(portfolio_io.export, message.from_user.id, fmt, file)
+        if not count:
+            await message.reply("Ваше портфолио пусто. Добавьте активы.")
+            return
+        file.flush()
+        await message.reply_document(types.InputFile(file.name, filename=f"portfolio.{fmt}"))
+
+# Команда /digest: подписка на регулярную сводку по портфелю
+async def digest_command(message: types.Message):
+    period = message.get_args().strip().lower()
+    if period == 'off':
+        await digest.unsubscribe(message.from_user.id)
+        await message.reply("Сводки отключены.")
+    elif period in DIGEST_PERIODS:
+        await digest.subscribe(message.from_user.id, period)
+        await message.reply(f"Подписка оформлена: {DIGEST_PERIODS[period][1].lower()}.")
+    else:
+        current = await digest.subscription(message.from_user.id)
+        status = DIGEST_PERIODS[current][1].lower() if current else "нет подписки"
+        await message.reply(f"Сводка: {status}. Формат: /digest [hourly|daily|off]")
+
+HISTORY_BARS = '▁▂▃▄▅▆▇█'
+
+# Команда /history: динамика стоимости текущих активов по сохранённой истории цен
+async def history_command(message: types.Message):
+    period = message.get_args().strip().lower() or '7d'
+    if period not in PERIODS:
+        await message.reply("Формат: /history [1d|7d|30d]")
+        return
+    assets = await db.get_portfolio(message.from_user.id)
+    if not assets:
+        await message.reply("Ваше портфолио пусто. Добавьте активы.")
+        return
+    # История хранит цены в валюте поставщика: количество переводится в базовую валюту
+    # по уже загруженной ленте ЦБ, без ожидания свежей
+    base = await db.get_base_currency(message.from_user.id)
+    rates = await portfolio_valuation.rates(cached=True)
+    assets = [
+        (asset_name, amount * rates.rate(PRICE_UNITS[asset_type], base), asset_type)
+        for asset_name, amount, asset_type in assets
+    ]
+    values, missing = await price_history.portfolio_value(assets, period)
+    missing_note = ''
+    if missing:
+        missing_note = "\nБез учёта (нет истории цен): " + ", ".join(asset_name for _, asset_name in missing)
+    if len(values) < 2:
+        await message.reply("История цен за этот период пока не накоплена." + missing_note)
+        return
+    totals = [value for ts, value in values]
+    first, last, low, high = totals[0], totals[-1], min(totals), max(totals)
+    # Не более 24 столбиков: берём равномерную выборку точек
+    sample = totals[::max(1, len(totals) // 24)]
+    bars = ''.join(
+        HISTORY_BARS[int((value - low) / (high - low) * (len(HISTORY_BARS) - 1)) if high > low else 0]
+        for value in sample
+    )
+    change = (last - first) / first * 100 if first else 0.0
+    await message.reply(
+        f"Стоимость портфеля за {period}, {base}:\n{bars}\n"
+        f"Начало: {first:.2f}, сейчас: {last:.2f} ({change:+.2f}%)\n"
+        f"Минимум: {low:.2f}, максимум: {high:.2f}\n"
+        f"С {datetime.fromtimestamp(values[0][0]):%d.%m %H:%M}" + missing_note
+    )
+
+ALERT_USAGE = (
+    "Формат: /alert [crypto|currency|stock] ТИКЕР >|< ЦЕНА\n"
+    "Например: /alert BTC > 70000 или /alert currency USD < 90"
+)
+# Фоновая проверка не расходует квоту Alpha Vantage и видит только свежие котировки из кэша
+ALERT_STOCK_NOTE = (
+    "\n⚠️ Алерты по акциям проверяются только по свежим котировкам, которые запрашивались в боте "
+    "(бесплатная квота Alpha Vantage - 25 запросов в сутки). Без них алерт не сработает."
+)
+ALERT_DIRECTIONS = {'>': ABOVE, '>=': ABOVE, '<': BELOW, '<=': BELOW}
+
+# Команда /alert: создание алерта на цену актива
+async def alert_command(message: types.Message):
+    parts = message.get_args().split()
+    asset_type = None
+    if parts and parts[0].lower() in ('crypto', 'currency', 'stock'):
+        asset_type = parts.pop(0).lower()
+    if len(parts) != 3 or parts[1] not in ALERT_DIRECTIONS:
+        await message.reply(ALERT_USAGE)
+        return
+    ticker = parts[0].upper()
+    try:
+        threshold = float(parts[2].replace(',', '.'))
+    except ValueError:
+        threshold = math.nan
+    # nan или inf в общем отсортированном списке порогов сломали бы бинарный поиск для всех алертов символа
+    if not math.isfinite(threshold) or threshold <= 0:
+        await message.reply(ALERT_USAGE)
+        return
+    if asset_type is None:
+        # Тип актива определяем по индексу тикеров, по умолчанию считаем тикер криптовалютой
+        asset_type = next((t for t in ('crypto', 'currency', 'stock') if symbol_index.contains(t, ticker)), 'crypto')
+    elif symbol_index.contains(asset_type, ticker) is False:
+        await message.reply(f"Тикер {ticker} не найден. Пожалуйста, проверьте корректность тикера.")
+        return
+    alert = await alert_engine.add(message.from_user.id, asset_type, ticker, ALERT_DIRECTIONS[parts[1]], threshold)
+    direction = 'выше' if alert.direction == ABOVE else 'ниже'
+    text = f"Алерт #{alert.id} создан: {ticker} {direction} {threshold}"
+    if asset_type == 'stock':
+        text += ALERT_STOCK_NOTE
+    await message.reply(text)
+
+# Команда /alerts: список активных алертов пользователя
+async def alerts_command(message: types.Message):
+    alerts = await alert_engine.user_alerts(message.from_user.id)
+    if not alerts:
+        await message.reply("У вас нет активных алертов. " + ALERT_USAGE)
+        return
+    lines = [
+        f"#{alert.id} {alert.asset_name} {'выше' if alert.direction == ABOVE else 'ниже'} {alert.threshold}"
+        for alert in alerts
+    ]
+    await message.reply("Ваши алерты:\n" + "\n".join(lines) + "\nУдалить: /unalert НОМЕР")
+
+# Команда /unalert: удаление алерта по номеру
+async def unalert_command(message: types.Message):
+    try:
+        alert_id = int(message.get_args().strip().lstrip('#'))
+    except ValueError:
+        await message.reply("Формат: /unalert НОМЕР")
+        return
+    if await alert_engine.remove(message.from_user.id, alert_id):
+        await message.reply(f"Алерт #{alert_id} удалён.")
+    else:
+        await message.reply(f"Алерт #{alert_id} не найден.")
+
+# Подключаемся к потоку котировок и запускаем проверку алертов при запуске бота
+async def on_startup(dp):
+    global metrics_server
+    # Метрики и профилировщик - на отдельном внутреннем порту METRICS_PORT, который не публикуется наружу.
+    # В режиме webhook порт 8000 занят приёмом обновлений от Telegram, поэтому по умолчанию 9100
+    port = int(os.getenv('METRICS_PORT', 9100 if os.getenv('BOT_MODE') == 'webhook' else 8000))
+    if port:
+        metrics_server = metrics.MetricsServer(port=port, profiler=profiler)
+        await metrics_server.start()
+    symbol_loader.start()
+    alert_engine.start()
+    history_recorder.start()
+    digest.start()
+    if binance_stream is not None:
+        binance_stream.start()
+
+# Закрываем поток и пул соединений с поставщиками при остановке бота
+async def on_shutdown(dp):
+    await symbol_loader.stop()
+    await alert_engine.stop()
+    await history_recorder.stop()
+    await digest.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    if binance_stream is not None:
+        await binance_stream.stop()
+    await http.close()
+    # Сбрасываем буфер состояний до закрытия базы
+    await dp.storage.close()
+    db.close()
+
+# Регистрация обработчиков в диспетчере, созданном фабрикой приложения
+def register_handlers(dp: Dispatcher):
+    dp.register_callback_query_handler(process_asset_choice, lambda c: c.data in ['crypto', 'currency', 'stock'], state=Portfolio.waiting_for_asset_type)
+    dp.register_message_handler(start, commands=['start'])
+    dp.register_message_handler(help_command, commands=['help'])
+    dp.register_message_handler(alert_command, commands=['alert'], state='*')
+    dp.register_message_handler(alerts_command, commands=['alerts'], state='*')
+    dp.register_message_handler(unalert_command, commands=['unalert'], state='*')
+    dp.register_message_handler(history_command, commands=['history'], state='*')
+    dp.register_message_handler(base_command, commands=['base'], state='*')
+    dp.register_message_handler(digest_command, commands=['digest'], state='*')
+    dp.register_message_handler(import_command, commands=['import'], state='*')
+    dp.register_message_handler(export_command, commands=['export'], state='*')
+    dp.register_message_handler(import_document, content_types=types.ContentType.DOCUMENT, state='*')
+    dp.register_message_handler(currency_command, Text(equals="💵Валюта", ignore_case=True))
+    dp.register_message_handler(currency_rate_command, state=CurrencyState.waiting_for_asset)
+    dp.register_message_handler(start_crypto_process, Text(equals="💸Крипто", ignore_case=True))
+    dp.register_message_handler(crypto_command, state=PriceState.waiting_for_asset)
+    dp.register_message_handler(start_price_process, Text(equals="📈Акции", ignore_case=True))
+    dp.register_message_handler(stock_command, state=StockState.waiting_for_asset)
+    dp.register_message_handler(add_to_portfolio, Text(equals="Добавить актив", ignore_case=True))
+    dp.register_message_handler(process_asset_type, Text(equals=["Крипто", "💵Валюта", "Акции"], ignore_case=True), state=Portfolio.waiting_for_asset_type)
+    dp.register_message_handler(process_asset_ticker, state=Portfolio.waiting_for_asset_ticker)
+    dp.register_callback_query_handler(process_ticker_suggestion, lambda c: c.data.startswith('ticker:'), state=Portfolio.waiting_for_asset_ticker)
+    dp.register_inline_handler(inline_ticker_search, state='*')
+    dp.register_message_handler(process_asset_amount, state=Portfolio.waiting_for_amount)
+    dp.register_message_handler(portfolio_command, Text(equals="Портфель", ignore_case=True))
+
+# Запуск бота: BOT_MODE=webhook поднимает HTTP-сервер на порту 8000, иначе long polling
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    dp = create_app()
+    if os.getenv('BOT_MODE') == 'webhook':
+        run_webhook(
+            dp,
+            url=os.getenv('WEBHOOK_URL'),
+            path=os.getenv('WEBHOOK_PATH', '/webhook'),
+            port=int(os.getenv('WEBAPP_PORT', 8000)),
+            secret_token=os.getenv('WEBHOOK_SECRET'),
+            workers=int(os.getenv('WEBHOOK_WORKERS', 16)),
+            queue_size=int(os.getenv('WEBHOOK_QUEUE_SIZE', 1000)),
+            on_startup=on_startup,
+            on_shutdown=on_shutdown,
+        )
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
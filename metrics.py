@@ -0,0 +1,338 @@
+import bisect
+import functools
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from contextvars import ContextVar
+from aiohttp import web
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# Метрики в текстовом формате Prometheus без внешних зависимостей.
+# Гистограмма - это счётчики по фиксированным корзинам, поэтому наблюдение стоит
+# один бинарный поиск и два сложения; значения читаются только при запросе /metrics.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []  # функции, возвращающие строки метрик в момент запроса
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, fn):
+        self._collectors.append(fn)
+        return fn
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            lines.extend(collect())
+        return '\n'.join(lines) + '\n'
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        (registry or REGISTRY).register(self)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # {метки: [счётчики корзин..., +Inf, сумма]}
+        (registry or REGISTRY).register(self)
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    # Замер длительности блока: with histogram.time('label'): ...
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.labels + ('le',), labels + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {series[-1]}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', "Время выполнения обработчика aiogram", ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', "Исключения в обработчиках aiogram", ['handler'])
+TELEGRAM_SECONDS = Histogram('bot_telegram_request_seconds', "Время запроса к Telegram Bot API", ['method'])
+TELEGRAM_ERRORS = Counter('bot_telegram_errors_total', "Ошибки запросов к Telegram Bot API", ['method'])
+PROVIDER_SECONDS = Histogram('bot_provider_seconds', "Время вызова поставщика цен через политику", ['provider', 'method'])
+PROVIDER_ERRORS = Counter('bot_provider_errors_total', "Неудачные вызовы поставщиков цен", ['provider', 'method'])
+RATE_SECONDS = Histogram('bot_rate_seconds', "Время получения курса для обработчика", ['function'])
+RATE_ERRORS = Counter('bot_rate_errors_total', "Курсы, отданные пользователю как ошибка", ['function'])
+DB_SECONDS = Histogram('bot_db_query_seconds', "Время выполнения запроса SQLite в потоке базы", ['query'])
+DB_ERRORS = Counter('bot_db_errors_total', "Исключения в запросах SQLite", ['query'])
+
+
+_caches = []  # [(имя, кэш с атрибутами hits и misses)]
+_policies = []  # политики поставщиков из policy.py
+
+# Кэши с атрибутами hits и misses: доля попаданий считается при запросе /metrics
+def register_cache(name, cache):
+    _caches.append((name, cache))
+
+# Состояние автоматов размыкания и хеджирования политик поставщиков
+def register_policy(policy):
+    _policies.append(policy)
+
+
+@REGISTRY.collector
+def _collect_caches():
+    yield "# TYPE bot_cache_hits_total counter"
+    for name, cache in _caches:
+        yield f"bot_cache_hits_total{_labels(('cache',), (name,))} {cache.hits}"
+    yield "# TYPE bot_cache_misses_total counter"
+    for name, cache in _caches:
+        yield f"bot_cache_misses_total{_labels(('cache',), (name,))} {cache.misses}"
+    yield "# TYPE bot_cache_hit_ratio gauge"
+    for name, cache in _caches:
+        total = cache.hits + cache.misses
+        yield f"bot_cache_hit_ratio{_labels(('cache',), (name,))} {cache.hits / total if total else 0.0}"
+
+
+@REGISTRY.collector
+def _collect_policies():
+    stats = [(_labels(('provider',), (policy.name,)), policy.stats()) for policy in _policies]
+    yield "# TYPE bot_provider_circuit_open gauge"
+    for labels, values in stats:
+        yield f"bot_provider_circuit_open{labels} {int(values['state'] != 'closed')}"
+    yield "# TYPE bot_provider_hedged_total counter"
+    for labels, values in stats:
+        yield f"bot_provider_hedged_total{labels} {values['hedged']}"
+    yield "# TYPE bot_provider_stale_served_total counter"
+    for labels, values in stats:
+        yield f"bot_provider_stale_served_total{labels} {values['stale_served']}"
+    yield "# TYPE bot_provider_failures_total counter"
+    for labels, values in stats:
+        yield f"bot_provider_failures_total{labels} {values['failures']}"
+
+
+# Замер корутины-курса: исключения и строки с ошибкой считаются ошибками
+def timed_rate(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception:
+            RATE_ERRORS.inc(fn.__name__)
+            raise
+        finally:
+            RATE_SECONDS.observe(time.perf_counter() - started, fn.__name__)
+        if isinstance(result, str):
+            RATE_ERRORS.inc(fn.__name__)
+        return result
+    return wrapper
+
+
+_handler = ContextVar('metrics_handler', default=None)
+
+# Middleware замеряет каждый обработчик: имя берётся из current_handler после прохождения фильтров.
+# post_process вызывается и при исключении, а ошибка засчитывается обработчиком ошибок диспетчера.
+class MetricsMiddleware(BaseMiddleware):
+    async def trigger(self, action, args):
+        # Обновление целиком и обработчики ошибок не замеряются
+        if action == 'pre_process_update':
+            _handler.set(None)
+        if action.endswith(('_update', '_error')):
+            return True
+        if action.startswith('process_'):
+            handler = current_handler.get()
+            name = getattr(handler, '__name__', repr(handler))
+            args[-1]['_metrics_handler'] = (name, time.perf_counter())
+            _handler.set(name)
+        elif action.startswith('post_process_'):
+            started = args[-1].pop('_metrics_handler', None)
+            if started is not None:
+                HANDLER_SECONDS.observe(time.perf_counter() - started[1], started[0])
+        return True
+
+
+async def count_handler_error(update, exception):
+    HANDLER_ERRORS.inc(_handler.get() or 'unknown')
+    # Исключение не считается обработанным: диспетчер пробросит его дальше
+
+
+# Подключение метрик обработчиков к диспетчеру
+def instrument(dp):
+    dp.middleware.setup(MetricsMiddleware())
+    dp.register_errors_handler(count_handler_error)
+
+
+# Бот, замеряющий каждый запрос к Telegram Bot API
+class MetricsBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception:
+            TELEGRAM_ERRORS.inc(method)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, method)
+
+
+# Семплирующий профилировщик: фоновый поток раз в interval секунд снимает стек
+# потока цикла событий. Отчёт - свёрнутые стеки (формат flamegraph.pl / speedscope).
+class SamplingProfiler:
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = _Tally()
+        self._thread = None
+        self._stop = threading.Event()
+        self._target = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # Вызывается из потока, который нужно профилировать
+    def start(self):
+        if self.running:
+            return
+        self.samples.clear()
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+        self._thread = None
+
+    def report(self):
+        return '\n'.join(f"{stack} {count}" for stack, count in self.samples.most_common()) + '\n'
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+
+# HTTP-эндпоинты: /metrics всегда, профилировщик - только если он передан (PROFILER=1).
+# POST /debug/profiler/start и /debug/profiler/stop включают и выключают его на лету.
+def add_routes(app, profiler=None, registry=None):
+    registry = registry or REGISTRY
+
+    async def metrics(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    app.router.add_get('/metrics', metrics)
+    if profiler is None:
+        return app
+
+    async def profiler_start(request):
+        profiler.start()
+        return web.json_response({'running': True, 'interval': profiler.interval})
+
+    async def profiler_stop(request):
+        profiler.stop()
+        return web.Response(text=profiler.report(), content_type='text/plain')
+
+    async def profiler_report(request):
+        return web.Response(text=profiler.report(), content_type='text/plain')
+
+    app.router.add_post('/debug/profiler/start', profiler_start)
+    app.router.add_post('/debug/profiler/stop', profiler_stop)
+    app.router.add_get('/debug/profiler', profiler_report)
+    return app
+
+
+# Сервер метрик на внутреннем порту, отдельном от порта webhook, который открыт для Telegram
+class MetricsServer:
+    def __init__(self, host='0.0.0.0', port=8000, profiler=None):
+        self.host = host
+        self.port = port
+        self.profiler = profiler
+        self._runner = None
+
+    async def start(self):
+        self._runner = web.AppRunner(add_routes(web.Application(), self.profiler))
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
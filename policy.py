@@ -0,0 +1,219 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import OrderedDict, deque
+from providers import ProviderError, ProviderClientError
+from metrics import PROVIDER_SECONDS, PROVIDER_ERRORS
+
+log = logging.getLogger(__name__)
+
+# Скользящее окно длительностей последних успешных запросов
+class LatencyTracker:
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def record(self, duration):
+        self._samples.append(duration)
+
+    def percentile(self, q):
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+# Автомат размыкания: после failures ошибок подряд поставщик считается недоступным
+# на reset_after секунд, затем пропускается один пробный запрос
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failures=5, reset_after=30):
+        self.failures = failures
+        self.reset_after = reset_after
+        self.state = self.CLOSED
+        self._errors = 0
+        self._opened_at = 0.0
+
+    def allow(self):
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_after:
+                return False
+            self.state = self.HALF_OPEN
+            return True
+        # В полуоткрытом состоянии пробный запрос уже идёт, остальные отклоняются
+        return self.state == self.CLOSED
+
+    # Пропустит ли автомат запрос сейчас; в отличие от allow() состояние не меняет
+    def available(self):
+        if self.state == self.OPEN:
+            return time.monotonic() - self._opened_at >= self.reset_after
+        return self.state == self.CLOSED
+
+    def success(self):
+        self.state = self.CLOSED
+        self._errors = 0
+
+    def failure(self):
+        self._errors += 1
+        if self.state == self.HALF_OPEN or self._errors >= self.failures:
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+# Политика вызовов одного поставщика: дедлайн на весь вызов, повторный (хеджирующий)
+# запрос, если первый дольше p95 обычной задержки, автомат размыкания и последняя
+# удачная цена по каждому ключу на время недоступности поставщика.
+class ProviderPolicy:
+    def __init__(self, name, deadline=5.0, hedge=True, hedge_min=0.05, min_samples=20,
+                 failures=5, reset_after=30, stale_ttl=3600, stale_keys=256):
+        self.name = name
+        self.deadline = deadline
+        self.hedge = hedge  # только для идемпотентных запросов без расхода квоты
+        self.hedge_min = hedge_min
+        self.min_samples = min_samples  # до накопления статистики хеджирование не включается
+        self.stale_ttl = stale_ttl  # 0 - последние удачные результаты не хранятся и не отдаются
+        self.stale_keys = stale_keys  # сколько последних ключей хранить (LRU)
+        self.latency = LatencyTracker()
+        self.breaker = CircuitBreaker(failures, reset_after)
+        self._last_good = OrderedDict()  # {ключ: (время, результат)}, старые ключи в начале
+        self.hedged = 0
+        self.stale_served = 0
+        self.failures = 0
+
+    def hedge_delay(self):
+        if not self.hedge or len(self.latency) < self.min_samples:
+            return None
+        return max(self.latency.percentile(0.95), self.hedge_min)
+
+    # fn и fallback - корутинные функции без аргументов
+    async def call(self, key, fn, fallback=None):
+        if not self.breaker.allow():
+            return await self._degraded(key, ProviderError(f"{self.name} временно недоступен"), fallback)
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(self._hedged(fn), self.deadline)
+        except asyncio.TimeoutError:
+            self._failed()
+            return await self._degraded(
+                key, ProviderError(f"{self.name}: превышено время ожидания ({self.deadline} с)"), fallback
+            )
+        except ProviderClientError:
+            # Поставщик ответил - ошибка в запросе, а не в доступности
+            self.breaker.success()
+            raise
+        except ProviderError as e:
+            self._failed()
+            return await self._degraded(key, e, fallback)
+        except asyncio.CancelledError:
+            # Отменённый пробный запрос не должен оставить автомат в полуоткрытом состоянии
+            if self.breaker.state == CircuitBreaker.HALF_OPEN:
+                self._failed()
+            raise
+        self.latency.record(time.monotonic() - started)
+        self.breaker.success()
+        if self.stale_ttl > 0:
+            self._remember(key, result)
+        return result
+
+    def _remember(self, key, result):
+        self._last_good[key] = (time.monotonic(), result)
+        self._last_good.move_to_end(key)
+        while len(self._last_good) > self.stale_keys:
+            self._last_good.popitem(last=False)
+
+    def _failed(self):
+        self.failures += 1
+        self.breaker.failure()
+
+    async def _hedged(self, fn):
+        delay = self.hedge_delay()
+        first = asyncio.ensure_future(fn())
+        if delay is None:
+            return await first
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedged += 1
+                tasks.add(asyncio.ensure_future(fn()))
+            # Побеждает первый успешный ответ; ошибка одной попытки ждёт вторую
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    if isinstance(task.exception(), ProviderClientError):
+                        raise task.exception()
+                error = next(iter(done)).exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            if not first.done():
+                first.cancel()
+
+    async def _degraded(self, key, error, fallback):
+        if fallback is not None:
+            try:
+                return await asyncio.wait_for(fallback(), self.deadline)
+            except (asyncio.TimeoutError, ProviderError) as e:
+                log.warning("%s fallback failed: %s", self.name, e)
+        cached = self._last_good.get(key)
+        if cached is not None and time.monotonic() - cached[0] < self.stale_ttl:
+            self.stale_served += 1
+            return cached[1]
+        raise error
+
+    def stats(self):
+        return {
+            'state': self.breaker.state,
+            'p95': self.latency.percentile(0.95),
+            'hedged': self.hedged,
+            'stale_served': self.stale_served,
+            'failures': self.failures,
+        }
+
+# Клиент поставщика, методы которого из списка methods вызываются через политику,
+# а остальные (например, фоновая загрузка списков тикеров) - напрямую.
+# Ключ последней удачной цены - имя метода и аргументы; резервный клиент
+# с теми же методами (например, зеркало API) вызывается при сбое основного.
+class GuardedClient:
+    def __init__(self, client, policy: ProviderPolicy, methods, fallback=None):
+        self.client = client
+        self.policy = policy
+        self.methods = set(methods)
+        self.fallback = fallback
+
+    # Уйдёт ли запрос к поставщику: при разомкнутом автомате политика ответит без запроса
+    def available(self):
+        return self.policy.breaker.available()
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        if name not in self.methods:
+            return method
+
+        async def guarded(*args, **kwargs):
+            key = (name, _freeze(args), _freeze(sorted(kwargs.items())))
+            fallback = None
+            if self.fallback is not None:
+                fallback = functools.partial(getattr(self.fallback, name), *args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return await self.policy.call(key, functools.partial(method, *args, **kwargs), fallback)
+            except Exception:
+                PROVIDER_ERRORS.inc(self.policy.name, name)
+                raise
+            finally:
+                PROVIDER_SECONDS.observe(time.perf_counter() - started, self.policy.name, name)
+        return guarded
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    return value
@@ -0,0 +1,184 @@
+import csv
+import io
+import json
+import math
+from collections import namedtuple
+
+ASSET_TYPES = ('crypto', 'currency', 'stock')
+FORMATS = ('csv', 'json')
+MAX_ROWS = 5000  # строк в одном файле импорта
+EXPORT_CHUNK = 500  # строк, читаемых из курсора за раз при экспорте
+
+ImportRow = namedtuple('ImportRow', 'line asset_type asset_name amount')
+
+# Названия колонок, которые встречаются в выгрузках брокеров и в нашем экспорте
+COLUMN_ALIASES = {
+    'asset_type': 'asset_type', 'type': 'asset_type', 'тип': 'asset_type',
+    'asset_name': 'asset_name', 'ticker': 'asset_name', 'symbol': 'asset_name', 'тикер': 'asset_name',
+    'amount': 'amount', 'quantity': 'amount', 'qty': 'amount', 'количество': 'amount',
+}
+
+
+class PortfolioFileError(ValueError):
+    pass
+
+
+def file_format(filename):
+    extension = (filename or '').rsplit('.', 1)[-1].lower()
+    if extension in ('json', 'jsonl'):
+        return 'json'
+    if extension in ('csv', 'txt'):
+        return 'csv'
+    raise PortfolioFileError("Поддерживаются файлы .csv и .json")
+
+# Потоковый разбор файла: строки читаются по одной и сразу проверяются.
+# Возвращает ([ImportRow], [строка с ошибкой]); одинаковые активы в файле суммируются.
+def parse(binary_file, fmt, max_rows=MAX_ROWS):
+    try:
+        return _parse(binary_file, fmt, max_rows, 'utf-8-sig')
+    except UnicodeDecodeError:
+        if fmt != 'csv' or not binary_file.seekable():
+            raise PortfolioFileError("Файл должен быть в кодировке UTF-8")
+    # Excel с русской локалью сохраняет CSV в cp1251
+    binary_file.seek(0)
+    try:
+        return _parse(binary_file, fmt, max_rows, 'cp1251')
+    except UnicodeDecodeError:
+        raise PortfolioFileError("Не удалось определить кодировку файла, сохраните его в UTF-8")
+
+def _parse(binary_file, fmt, max_rows, encoding):
+    text = io.TextIOWrapper(binary_file, encoding=encoding, newline='')
+    records = _csv_records(text) if fmt == 'csv' else _json_records(text)
+    label = 'Строка' if fmt == 'csv' else 'Запись'
+    rows = {}
+    errors = []
+    try:
+        for count, (line, record) in enumerate(records, start=1):
+            if count > max_rows:
+                raise PortfolioFileError(f"В файле больше {max_rows} строк")
+            try:
+                row = _row(line, record)
+            except PortfolioFileError as e:
+                errors.append(f"{label} {line}: {e}")
+                continue
+            key = (row.asset_type, row.asset_name)
+            if key in rows:
+                row = rows[key]._replace(amount=rows[key].amount + row.amount)
+            rows[key] = row
+    except csv.Error as e:
+        raise PortfolioFileError(f"Некорректный CSV: {e}")
+    finally:
+        # Файл остаётся открытым: при ошибке кодировки его читают заново
+        text.detach()
+    return list(rows.values()), errors
+
+def _row(line, record):
+    if not isinstance(record, dict):
+        raise PortfolioFileError("ожидается объект с полями asset_type, asset_name, amount")
+    fields = {COLUMN_ALIASES.get(str(key).strip().lower()): value for key, value in record.items()}
+    asset_type = str(fields.get('asset_type') or '').strip().lower()
+    asset_name = str(fields.get('asset_name') or '').strip().upper()
+    if asset_type not in ASSET_TYPES:
+        raise PortfolioFileError(f"неизвестный тип актива {asset_type!r}")
+    if not asset_name:
+        raise PortfolioFileError("не указан тикер")
+    try:
+        amount = float(str(fields.get('amount')).replace(',', '.').replace(' ', ''))
+    except ValueError:
+        amount = math.nan
+    if not math.isfinite(amount):
+        raise PortfolioFileError(f"некорректное количество {fields.get('amount')!r}")
+    if amount <= 0:
+        raise PortfolioFileError("количество должно быть больше нуля")
+    return ImportRow(line, asset_type, asset_name, amount)
+
+def _csv_records(text):
+    header = text.readline()
+    # Excel с русской локалью сохраняет CSV через точку с запятой
+    delimiter = ';' if header.count(';') > header.count(',') else ','
+    columns = next(csv.reader([header], delimiter=delimiter), [])
+    for line, values in enumerate(csv.reader(text, delimiter=delimiter), start=2):
+        if any(value.strip() for value in values):
+            yield line, dict(zip(columns, values))
+
+# JSON-массив объектов разбирается по одному объекту с помощью raw_decode,
+# без загрузки всего документа; JSON Lines (объект на строку) тоже поддерживается
+def _json_records(text, chunk_size=65536):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    number = 0
+    started = False
+    while True:
+        # Пропускаем разделители между объектами
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if not started and position < len(buffer):
+            started = True
+            if buffer[position] == '[':
+                position += 1
+                continue
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        if position >= len(buffer) and eof:
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # Объект не заканчивается ни в конце файла, ни за мегабайт - файл повреждён
+            if eof or len(buffer) - position > 1 << 20:
+                raise PortfolioFileError("Некорректный JSON")
+            chunk = text.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        number += 1
+        position = end
+        yield number, record
+
+# Проверка тикеров по индексу без запросов к поставщикам цен: неизвестным считается
+# только тикер, которого нет в загруженном списке. Строки типов, список которых
+# недоступен, принимаются без проверки. Возвращает (неизвестные, непроверенные)
+# множества {(asset_type, asset_name)}.
+def check_assets(rows, symbol_index):
+    unknown = set()
+    unchecked = set()
+    for row in rows:
+        exists = symbol_index.contains(row.asset_type, row.asset_name)
+        if exists is None:
+            unchecked.add((row.asset_type, row.asset_name))
+        elif not exists:
+            unknown.add((row.asset_type, row.asset_name))
+    return unknown, unchecked
+
+# Экспорт идёт из курсора порциями прямо в файл, весь портфель в памяти не собирается
+def export(conn, user_id, fmt, file):
+    cursor = conn.execute(
+        'SELECT asset_type, asset_name, amount FROM portfolio WHERE user_id = ? ORDER BY asset_type, asset_name',
+        (user_id,),
+    )
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(['asset_type', 'asset_name', 'amount'])
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                break
+            writer.writerows(rows)
+            count += len(rows)
+    else:
+        file.write('[')
+        while True:
+            rows = cursor.fetchmany(EXPORT_CHUNK)
+            if not rows:
+                break
+            for asset_type, asset_name, amount in rows:
+                file.write((',\n ' if count else '\n ') + json.dumps(
+                    {'asset_type': asset_type, 'asset_name': asset_name, 'amount': amount}, ensure_ascii=False
+                ))
+                count += 1
+        file.write('\n]\n')
+    return count
@@ -0,0 +1,138 @@
+import asyncio
+import csv
+import io
+import json
+import aiohttp
+
+# Ошибка обращения к поставщику цен: таймаут, сетевой сбой или ответ с ошибкой
+class ProviderError(Exception):
+    pass
+
+# Ответ 4xx на сам запрос (неверный символ, параметры): поставщик работает,
+# поэтому такие ошибки не размыкают автомат и не повторяются
+class ProviderClientError(ProviderError):
+    pass
+
+# 418 и 429 - ограничение частоты запросов, это сбой поставщика, а не ошибка запроса
+def _http_error(status, message=None):
+    if 400 <= status < 500 and status not in (418, 429):
+        return ProviderClientError(message or f"HTTP {status}")
+    return ProviderError(message or f"HTTP {status}")
+
+# HTTP-клиент с общей сессией: пул keep-alive соединений на всех поставщиков
+# и собственный дедлайн у каждого запроса, чтобы медленный ответ не держал обработчик
+class HttpClient:
+    def __init__(self, limit=100, limit_per_host=20):
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._session = None
+        self._loop = None
+
+    def session(self):
+        loop = asyncio.get_running_loop()
+        # Сессия привязана к циклу событий, поэтому при смене цикла создаём новую
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._loop = loop
+        return self._session
+
+    async def get_json(self, url, params=None, timeout=5.0):
+        try:
+            async with self.session().get(url, params=params, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                data = await response.json(content_type=None)
+                if response.status >= 400:
+                    message = data.get('msg') if isinstance(data, dict) else None
+                    raise _http_error(response.status, message)
+                return data
+        except asyncio.TimeoutError:
+            raise ProviderError(f"Превышено время ожидания ответа ({timeout} с)")
+        except (aiohttp.ClientError, ValueError) as e:
+            raise ProviderError(str(e))
+
+    async def get_text(self, url, params=None, timeout=5.0):
+        try:
+            async with self.session().get(url, params=params, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status >= 400:
+                    raise _http_error(response.status)
+                return await response.text()
+        except asyncio.TimeoutError:
+            raise ProviderError(f"Превышено время ожидания ответа ({timeout} с)")
+        except aiohttp.ClientError as e:
+            raise ProviderError(str(e))
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+# Лента курсов ЦБ РФ
+class CbrClient:
+    base_url = 'https://www.cbr-xml-daily.ru'
+
+    def __init__(self, http: HttpClient, base_url=None, timeout=5.0):
+        self.http = http
+        self.base_url = base_url or self.base_url
+        self.timeout = timeout
+
+    async def daily(self):
+        return await self.http.get_json(f"{self.base_url}/daily_json.js", timeout=self.timeout)
+
+# Публичный REST API Binance (ключи для котировок не нужны)
+class BinanceClient:
+    base_url = 'https://api.binance.com'
+
+    def __init__(self, http: HttpClient, base_url=None, timeout=3.0):
+        self.http = http
+        self.base_url = base_url or self.base_url
+        self.timeout = timeout
+
+    async def ticker_price(self, symbol: str):
+        return await self.http.get_json(
+            f"{self.base_url}/api/v3/ticker/price", params={'symbol': symbol}, timeout=self.timeout
+        )
+
+    # Цены нескольких символов одним запросом; без списка - цены всех символов биржи
+    async def ticker_prices(self, symbols=None):
+        params = None
+        if symbols:
+            params = {'symbols': json.dumps(list(symbols), separators=(',', ':'))}
+        data = await self.http.get_json(f"{self.base_url}/api/v3/ticker/price", params=params, timeout=self.timeout)
+        return {item['symbol']: float(item['price']) for item in data}
+
+    # Базовые активы всех торгуемых спотовых пар к USDT
+    async def usdt_assets(self):
+        data = await self.http.get_json(
+            f"{self.base_url}/api/v3/exchangeInfo", params={'permissions': 'SPOT'}, timeout=max(self.timeout, 10.0)
+        )
+        return [
+            item['baseAsset'] for item in data.get('symbols', [])
+            if item.get('quoteAsset') == 'USDT' and item.get('status') == 'TRADING'
+        ]
+
+# Alpha Vantage
+class AlphaVantageClient:
+    base_url = 'https://www.alphavantage.co'
+
+    def __init__(self, http: HttpClient, api_key, base_url=None, timeout=10.0):
+        self.http = http
+        self.api_key = api_key
+        self.base_url = base_url or self.base_url
+        self.timeout = timeout
+
+    async def query(self, **params):
+        params['apikey'] = self.api_key or ''
+        return await self.http.get_json(f"{self.base_url}/query", params=params, timeout=self.timeout)
+
+    # Список активных тикеров (LISTING_STATUS отдаёт CSV, а не JSON)
+    async def listed_symbols(self):
+        text = await self.http.get_text(
+            f"{self.base_url}/query",
+            params={'function': 'LISTING_STATUS', 'apikey': self.api_key or ''},
+            timeout=max(self.timeout, 30.0),
+        )
+        return [row['symbol'] for row in csv.DictReader(io.StringIO(text)) if row.get('symbol')]
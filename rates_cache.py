@@ -0,0 +1,87 @@
+import asyncio
+import time
+from datetime import datetime
+
+# Кэш ежедневной ленты курсов ЦБ РФ, общий для всего процесса.
+# Лента обновляется раз в сутки, поэтому документ хранится до даты следующего
+# обновления (поле NextDate), а при его отсутствии - заданное время ttl.
+class RatesCache:
+    def __init__(self, fetch, ttl=3600, retry=300):
+        self._fetch = fetch  # корутина загрузки документа ленты
+        self._ttl = ttl  # время жизни, если лента не сообщает дату следующего обновления
+        self._retry = retry  # повторная проверка, если лента уже должна была обновиться
+        self._inflight = None
+        self._document = None
+        self._expires_at = 0.0
+        self.timestamp = None  # Timestamp текущего документа ленты
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self):
+        document = self._fresh()
+        if document is not None:
+            self.hits += 1
+            return document
+        # Одновременные промахи ждут одну загрузку вместо того, чтобы скачивать ленту каждый сам
+        if self._inflight is None or self._inflight.get_loop() is not asyncio.get_running_loop():
+            self.misses += 1
+            self._inflight = asyncio.ensure_future(self._load())
+        else:
+            self.hits += 1
+        # shield: отмена одного ожидающего обработчика не отменяет общую загрузку
+        return await asyncio.shield(self._inflight)
+
+    # Последний загруженный документ, даже устаревший, без обращения к ЦБ
+    def peek(self):
+        return self._document
+
+    def invalidate(self):
+        self._document = None
+        self._expires_at = 0.0
+        self.timestamp = None
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'timestamp': self.timestamp,
+            'expires_at': self._expires_at,
+        }
+
+    async def _load(self):
+        try:
+            document = await self._fetch()
+            self._store(document)
+            return document
+        finally:
+            self._inflight = None
+
+    def _fresh(self):
+        if self._document is not None and time.time() < self._expires_at:
+            return self._document
+        return None
+
+    def _store(self, document):
+        now = time.time()
+        timestamp = document.get('Timestamp')
+        next_date = _parse_date(document.get('NextDate'))
+        if next_date is not None and next_date > now:
+            expires_at = next_date
+        elif timestamp is not None and timestamp == self.timestamp:
+            # Лента ещё не обновилась - проверяем её чаще, чем раз в ttl
+            expires_at = now + self._retry
+        else:
+            expires_at = now + self._ttl
+        self._document = document
+        self._expires_at = expires_at
+        self.timestamp = timestamp
+
+
+# Даты в ленте ЦБ приходят в ISO-формате с часовым поясом, например 2024-10-17T11:30:00+03:00
+def _parse_date(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
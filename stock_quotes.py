@@ -0,0 +1,192 @@
+import asyncio
+import time
+from collections import deque, namedtuple
+from datetime import datetime, time as dtime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from providers import ProviderError
+
+# Торговая сессия NYSE/NASDAQ по нью-йоркскому времени (праздники не учитываются)
+MARKET_TZ = ZoneInfo('America/New_York')
+SESSION_OPEN = dtime(9, 30)
+SESSION_CLOSE = dtime(16, 0)
+
+Quote = namedtuple('Quote', 'symbol price trading_day fetched_at stale')
+
+def market_open(now: datetime):
+    now = now.astimezone(MARKET_TZ)
+    return now.weekday() < 5 and SESSION_OPEN <= now.time() < SESSION_CLOSE
+
+# Время закрытия последней завершённой торговой сессии
+def last_close(now: datetime):
+    now = now.astimezone(MARKET_TZ)
+    day = now.date()
+    if now.time() < SESSION_CLOSE:
+        day -= timedelta(days=1)
+    while day.weekday() >= 5:
+        day -= timedelta(days=1)
+    return datetime.combine(day, SESSION_CLOSE, tzinfo=MARKET_TZ)
+
+# Во время сессии котировка живёт session_ttl секунд, вне сессии - до следующего открытия
+def is_fresh(fetched_at, now: datetime, session_ttl):
+    if market_open(now):
+        return now.timestamp() - fetched_at < session_ttl
+    return fetched_at >= last_close(now).timestamp()
+
+# Бюджет запросов к Alpha Vantage: скользящее окно в минуту и счётчик за сутки (UTC).
+# Счётчик за сутки хранится в базе, чтобы перезапуск бота не обнулял израсходованную квоту.
+class RequestBudget:
+    def __init__(self, db, per_minute=5, per_day=25):
+        self.db = db
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self._recent = deque()  # время последних запросов в пределах минуты
+
+    @staticmethod
+    def _today():
+        return datetime.now(timezone.utc).date().isoformat()
+
+    async def used_today(self):
+        return await self.db.run(_used_today, self._today())
+
+    # Сколько секунд ждать свободного слота; None - суточная квота исчерпана
+    async def delay(self):
+        if await self.used_today() >= self.per_day:
+            return None
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] >= 60:
+            self._recent.popleft()
+        if len(self._recent) < self.per_minute:
+            return 0.0
+        return 60 - (now - self._recent[0])
+
+    async def spend(self):
+        self._recent.append(time.monotonic())
+        await self.db.run(_spend, self._today())
+
+# Котировки акций: лёгкий запрос GLOBAL_QUOTE, кэш в таблице stock_quotes,
+# очередь запросов в рамках бюджета и выдача сохранённой котировки, когда бюджет исчерпан.
+class StockQuotes:
+    def __init__(self, db, alpha_vantage, per_minute=5, per_day=25, session_ttl=900, max_wait=15):
+        self.db = db
+        self.alpha_vantage = alpha_vantage
+        self.budget = RequestBudget(db, per_minute, per_day)
+        self.session_ttl = session_ttl
+        self.max_wait = max_wait  # дольше этого запрос в очереди не ждёт и получает кэш
+        self._queue = None
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        db.call(_create_tables)
+
+    async def quote(self, symbol: str):
+        cached = await self._load(symbol)
+        if cached is not None and is_fresh(cached.fetched_at, datetime.now(timezone.utc), self.session_ttl):
+            self.hits += 1
+            return cached
+        self.misses += 1
+        # Одновременные запросы одного тикера ждут одну загрузку
+        future = self._inflight.get(symbol)
+        if future is None:
+            future = asyncio.ensure_future(self._refresh(symbol, cached))
+            self._inflight[symbol] = future
+            future.add_done_callback(lambda _: self._inflight.pop(symbol, None))
+        return await asyncio.shield(future)
+
+    # Только сохранённая котировка, без запроса к Alpha Vantage: для фоновых задач
+    # (история, алерты, сводки), которые иначе израсходовали бы суточную квоту
+    async def cached(self, symbol: str):
+        cached = await self._load(symbol)
+        if cached is None:
+            raise ProviderError(f"Нет сохранённой котировки {symbol}")
+        if not is_fresh(cached.fetched_at, datetime.now(timezone.utc), self.session_ttl):
+            return cached._replace(stale=True)
+        return cached
+
+    async def _refresh(self, symbol, cached):
+        if self._queue is None:
+            self._queue = asyncio.Lock()
+        # Запросы встают в очередь и выходят из неё не чаще, чем позволяет бюджет
+        async with self._queue:
+            # При разомкнутом автомате запрос не уйдёт к Alpha Vantage - квоту не списываем
+            available = getattr(self.alpha_vantage, 'available', None)
+            if available is not None and not available():
+                return self._fallback(cached, "Alpha Vantage временно недоступен")
+            delay = await self.budget.delay()
+            if delay is None or delay > self.max_wait:
+                return self._fallback(cached, "Лимит запросов к Alpha Vantage исчерпан")
+            if delay:
+                await asyncio.sleep(delay)
+            await self.budget.spend()
+        try:
+            data = await self.alpha_vantage.query(function='GLOBAL_QUOTE', symbol=symbol)
+        except ProviderError as e:
+            return self._fallback(cached, str(e))
+
+        quote = data.get('Global Quote') if isinstance(data, dict) else None
+        if not quote:
+            # Ответ с ограничением квоты приходит в полях Note/Information
+            message = (data.get('Note') or data.get('Information')) if isinstance(data, dict) else None
+            return self._fallback(cached, message or f"Тикер {symbol} не найден")
+        try:
+            price = float(quote['05. price'])
+        except (KeyError, TypeError, ValueError):
+            return self._fallback(cached, f"Некорректный ответ Alpha Vantage для {symbol}")
+        return await self._store(symbol, price, quote.get('07. latest trading day'))
+
+    def _fallback(self, cached, message):
+        if cached is None:
+            raise ProviderError(message)
+        return cached._replace(stale=True)
+
+    async def _load(self, symbol):
+        row = await self.db.run(_load_quote, symbol)
+        if row is None:
+            return None
+        return Quote(symbol, row[0], row[1], row[2], False)
+
+    async def _store(self, symbol, price, trading_day):
+        fetched_at = time.time()
+        await self.db.run(_store_quote, symbol, price, trading_day, fetched_at)
+        return Quote(symbol, price, trading_day, fetched_at, False)
+
+
+def _create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stock_quotes (
+        symbol TEXT PRIMARY KEY,
+        price REAL,
+        trading_day TEXT,
+        fetched_at REAL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS stock_quota (
+        day TEXT PRIMARY KEY,
+        used INTEGER
+    )
+    ''')
+    conn.commit()
+
+def _used_today(conn, day):
+    row = conn.execute('SELECT used FROM stock_quota WHERE day = ?', (day,)).fetchone()
+    return row[0] if row else 0
+
+def _spend(conn, day):
+    conn.execute('''
+        INSERT INTO stock_quota (day, used) VALUES (?, 1)
+        ON CONFLICT(day) DO UPDATE SET used = used + 1
+    ''', (day,))
+    conn.commit()
+
+def _load_quote(conn, symbol):
+    return conn.execute(
+        'SELECT price, trading_day, fetched_at FROM stock_quotes WHERE symbol = ?', (symbol,)
+    ).fetchone()
+
+def _store_quote(conn, symbol, price, trading_day, fetched_at):
+    conn.execute('''
+        INSERT INTO stock_quotes (symbol, price, trading_day, fetched_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(symbol) DO UPDATE SET
+            price = excluded.price, trading_day = excluded.trading_day, fetched_at = excluded.fetched_at
+    ''', (symbol, price, trading_day, fetched_at))
+    conn.commit()
@@ -0,0 +1,190 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import DB_SECONDS, DB_ERRORS
+
+# Хранилище SQLite: одно соединение в режиме WAL, все запросы выполняются
+# в отдельном потоке, чтобы не блокировать цикл событий бота.
+class Database:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA busy_timeout=5000')
+        self.lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+
+    # Выполняет fn(conn, *args) в потоке базы данных
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.call, fn, *args)
+
+    # Синхронный вызов для кода вне цикла событий (инициализация, миграции, тесты)
+    def call(self, fn, *args):
+        query = f"{fn.__module__}.{fn.__qualname__}"
+        with self.lock:
+            started = time.perf_counter()
+            try:
+                return fn(self.conn, *args)
+            except Exception:
+                DB_ERRORS.inc(query)
+                raise
+            finally:
+                DB_SECONDS.observe(time.perf_counter() - started, query)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self.lock:
+            self.conn.close()
+
+    def create_tables(self):
+        self.call(_create_tables)
+
+    async def add_user(self, user_id, username):
+        await self.run(_add_user, user_id, username)
+
+    # Атомарно прибавляет количество к активу пользователя и возвращает новое количество
+    async def add_asset(self, user_id, asset_type, asset_name, amount):
+        return await self.run(_add_asset, user_id, asset_type, asset_name, amount)
+
+    # Импорт: количества активов [(asset_type, asset_name, amount)] записываются одной транзакцией
+    async def set_assets(self, user_id, assets):
+        await self.run(_set_assets, user_id, assets)
+
+    async def get_portfolio(self, user_id):
+        return await self.run(_get_portfolio, user_id)
+
+    async def asset_names(self, asset_type):
+        return await self.run(_asset_names, asset_type)
+
+    async def get_base_currency(self, user_id):
+        return await self.run(_get_base_currency, user_id)
+
+    async def set_base_currency(self, user_id, currency):
+        await self.run(_set_base_currency, user_id, currency)
+
+    # Базовые валюты пользователей: {user_id: код}; без списка - всех пользователей
+    async def base_currencies(self, user_ids=None):
+        return await self.run(_base_currencies, user_ids)
+
+    # Строки портфелей (user_id, asset_name, amount, asset_type); без списка - всех пользователей
+    async def holdings(self, user_ids=None):
+        return await self.run(_holdings, user_ids)
+
+    # Все различные активы из портфелей: [(asset_name, asset_type)]
+    async def distinct_assets(self):
+        return await self.run(_distinct_assets)
+
+
+def _create_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        base_currency TEXT NOT NULL DEFAULT 'USD'
+    )
+    ''')
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(users)')]
+    if 'base_currency' not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN base_currency TEXT NOT NULL DEFAULT 'USD'")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS portfolio (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        asset_name TEXT,
+        amount REAL,
+        asset_type TEXT, -- 'currency', 'crypto', 'stock'
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    )
+    ''')
+    has_index = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'portfolio_user_asset'"
+    ).fetchone()
+    if not has_index:
+        # Сливаем дубликаты, накопившиеся до появления уникального индекса
+        conn.execute('''
+            UPDATE portfolio SET amount = (
+                SELECT SUM(p.amount) FROM portfolio p
+                WHERE p.user_id = portfolio.user_id
+                  AND p.asset_type = portfolio.asset_type
+                  AND p.asset_name = portfolio.asset_name
+            )
+            WHERE id IN (
+                SELECT MIN(id) FROM portfolio
+                GROUP BY user_id, asset_type, asset_name HAVING COUNT(*) > 1
+            )
+        ''')
+        conn.execute('''
+            DELETE FROM portfolio WHERE id NOT IN (
+                SELECT MIN(id) FROM portfolio GROUP BY user_id, asset_type, asset_name
+            )
+        ''')
+        conn.execute('CREATE UNIQUE INDEX portfolio_user_asset ON portfolio (user_id, asset_type, asset_name)')
+    conn.execute('CREATE INDEX IF NOT EXISTS portfolio_type_asset ON portfolio (asset_type, asset_name)')
+    conn.commit()
+
+def _add_user(conn, user_id, username):
+    conn.execute('INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)', (user_id, username))
+    conn.commit()
+
+def _add_asset(conn, user_id, asset_type, asset_name, amount):
+    row = conn.execute('''
+        INSERT INTO portfolio (user_id, asset_name, amount, asset_type)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, asset_type, asset_name) DO UPDATE SET amount = amount + excluded.amount
+        RETURNING amount
+    ''', (user_id, asset_name, amount, asset_type)).fetchone()
+    conn.commit()
+    return row[0]
+
+def _set_assets(conn, user_id, assets):
+    with conn:
+        conn.executemany('''
+            INSERT INTO portfolio (user_id, asset_name, amount, asset_type)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, asset_type, asset_name) DO UPDATE SET amount = excluded.amount
+        ''', [(user_id, asset_name, amount, asset_type) for asset_type, asset_name, amount in assets])
+
+def _get_portfolio(conn, user_id):
+    return conn.execute(
+        'SELECT asset_name, amount, asset_type FROM portfolio WHERE user_id = ?', (user_id,)
+    ).fetchall()
+
+def _asset_names(conn, asset_type):
+    return [name for (name,) in conn.execute(
+        'SELECT DISTINCT asset_name FROM portfolio WHERE asset_type = ?', (asset_type,)
+    )]
+
+def _get_base_currency(conn, user_id):
+    row = conn.execute('SELECT base_currency FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    return row[0] if row else 'USD'
+
+def _set_base_currency(conn, user_id, currency):
+    conn.execute('''
+        INSERT INTO users (user_id, base_currency) VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET base_currency = excluded.base_currency
+    ''', (user_id, currency))
+    conn.commit()
+
+def _base_currencies(conn, user_ids):
+    if user_ids is None:
+        return dict(conn.execute('SELECT user_id, base_currency FROM users'))
+    user_ids = list(user_ids)
+    return dict(conn.execute(
+        f"SELECT user_id, base_currency FROM users WHERE user_id IN ({','.join('?' * len(user_ids))})", user_ids
+    ))
+
+def _holdings(conn, user_ids):
+    if user_ids is None:
+        return conn.execute('SELECT user_id, asset_name, amount, asset_type FROM portfolio').fetchall()
+    user_ids = list(user_ids)
+    return conn.execute(
+        f"SELECT user_id, asset_name, amount, asset_type FROM portfolio WHERE user_id IN ({','.join('?' * len(user_ids))})",
+        user_ids,
+    ).fetchall()
+
+def _distinct_assets(conn):
+    return conn.execute('SELECT DISTINCT asset_name, asset_type FROM portfolio').fetchall()
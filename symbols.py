@@ -0,0 +1,81 @@
+import asyncio
+import bisect
+import logging
+import time
+from background import BackgroundService
+
+log = logging.getLogger(__name__)
+
+# Индекс тикеров по типам активов: проверка существования и поиск по префиксу без сетевых запросов
+class SymbolIndex:
+    def __init__(self):
+        self._sorted = {}  # {asset_type: отсортированный список тикеров}
+        self._sets = {}  # {asset_type: множество тикеров}
+        self.loaded_at = {}  # {asset_type: время последней загрузки}
+
+    def load(self, asset_type, symbols):
+        symbols = {symbol.upper() for symbol in symbols if symbol}
+        self._sorted[asset_type] = sorted(symbols)
+        self._sets[asset_type] = symbols
+        self.loaded_at[asset_type] = time.time()
+
+    def loaded(self, asset_type):
+        return bool(self._sets.get(asset_type))
+
+    # True/False, если тип загружен; None - индекс ещё пуст и проверять нужно у поставщика
+    def contains(self, asset_type, symbol):
+        if not self.loaded(asset_type):
+            return None
+        return symbol.upper() in self._sets[asset_type]
+
+    def prefix(self, asset_type, prefix, limit=10):
+        symbols = self._sorted.get(asset_type, [])
+        prefix = prefix.upper()
+        start = bisect.bisect_left(symbols, prefix)
+        result = []
+        for symbol in symbols[start:start + limit]:
+            if not symbol.startswith(prefix):
+                break
+            result.append(symbol)
+        return result
+
+# Фоновое обновление индекса: у каждого типа актива свой источник и период обновления.
+# Неудачная загрузка повторяется не раньше, чем через период источника: загрузка
+# списка акций расходует квоту Alpha Vantage даже при сбое.
+class SymbolLoader(BackgroundService):
+    def __init__(self, index: SymbolIndex, sources):
+        self.index = index
+        self.sources = sources  # {asset_type: (корутина загрузки тикеров, период в секундах)}
+        self.failed_at = {}  # {asset_type: время последней неудачной загрузки}
+
+    def _due(self, asset_type, now):
+        period = self.sources[asset_type][1]
+        attempted = max(self.index.loaded_at.get(asset_type, 0), self.failed_at.get(asset_type, 0))
+        return now - attempted >= period
+
+    async def refresh(self, force=False):
+        now = time.time()
+        await self._load([asset_type for asset_type in self.sources if force or self._due(asset_type, now)])
+
+    # Загрузка ещё не загруженных типов по требованию (например, перед импортом портфеля)
+    async def ensure(self, asset_types):
+        now = time.time()
+        await self._load([
+            asset_type for asset_type in asset_types
+            if asset_type in self.sources and not self.index.loaded(asset_type) and self._due(asset_type, now)
+        ])
+
+    async def _load(self, due):
+        results = await asyncio.gather(*(self.sources[t][0]() for t in due), return_exceptions=True)
+        for asset_type, symbols in zip(due, results):
+            # При ошибке источника остаётся прежний список тикеров
+            if isinstance(symbols, Exception):
+                log.warning("Failed to load %s symbols: %s", asset_type, symbols)
+                self.failed_at[asset_type] = time.time()
+            else:
+                self.index.load(asset_type, symbols)
+
+    async def _run(self, check_every=60):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(check_every)
@@ -1,20 +1,54 @@
+import asyncio
+import io
+import subprocess
+import sys
+import tempfile
 import unittest
 import json
 import os
+from datetime import datetime
 from dotenv import load_dotenv
 from unittest.mock import AsyncMock, patch, MagicMock
 from aiogram import Bot
+from aiogram import types
 from aiogram.types import Message
 from aiogram.dispatcher import FSMContext, Dispatcher
 from aiounittest import AsyncTestCase
-from main import get_currency_rate, get_crypto_rate, get_stock_rate, conn, cursor, process_asset_type, process_asset_ticker, process_asset_amount, add_to_portfolio, process_asset_type, process_asset_ticker, process_asset_amount, Portfolio, asset_type_inline_keyboard
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from providers import HttpClient, BinanceClient, ProviderError, ProviderClientError
+from valuation import Valuer
+from binance_stream import PriceTable, BinanceStream
+from stock_quotes import StockQuotes, MARKET_TZ, is_fresh
+from symbols import SymbolIndex, SymbolLoader
+from storage import Database
+import fsm_storage
+from fsm_storage import SQLiteStorage
+from webhook import WebhookServer
+from alerts import Alert, AlertIndex, AlertEngine, ABOVE, BELOW
+from history import PriceHistory, HistoryRecorder
+from crossrates import CrossRates, PortfolioValuation, value_rows
+from policy import ProviderPolicy, GuardedClient
+from digest import DigestBroadcaster
+import portfolio_io
+from aiogram.utils.exceptions import RetryAfter, BotBlocked
+import metrics
+# Тесты работают с временной базой, а не с app_data/database.db
+os.environ.setdefault('DATABASE_PATH', os.path.join(tempfile.mkdtemp(), 'database.db'))
+import main
+main.init_services()
+from main import currency_rates, get_currency_rate, get_crypto_rate, get_stock_rate, db, process_asset_type, process_asset_ticker, process_asset_amount, add_to_portfolio, process_asset_type, process_asset_ticker, process_asset_amount, Portfolio, asset_type_inline_keyboard
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 
-API_TOKEN = os.getenv('API_TOKEN')
+# Бот не обращается к Telegram при создании, поэтому без токена подойдёт фиктивный
+API_TOKEN = os.getenv('API_TOKEN') or '123456:ABCdefGHIjklMNOpqrSTUvwxYZ'
 
-class TestFinanceBot(unittest.TestCase):
-    @patch('main.requests.get')
-    def test_get_currency_rate(self, mock_get):
+class TestPriceProviders(AsyncTestCase):
+    def setUp(self):
+        currency_rates.invalidate()
+
+    @patch('main.cbr.daily', new_callable=AsyncMock)
+    async def test_get_currency_rate(self, mock_daily):
         # Пример ответа API ЦБ РФ
         mock_response = {
             "Valute": {
@@ -30,60 +64,745 @@ class TestFinanceBot(unittest.TestCase):
                 }
             }
         }
-        mock_get.return_value.json.return_value = mock_response
-        rates = get_currency_rate("USD")
+        mock_daily.return_value = mock_response
+        rates = await get_currency_rate("USD")
         self.assertIn("USD", rates)
         self.assertEqual(rates["USD"]["Value"], 76.32)
         self.assertEqual(rates["USD"]["Name"], "Доллар США")
 
-    @patch('main.client.get_symbol_ticker')
-    def test_get_crypto_rate(self, mock_get_symbol_ticker):
+    @patch('main.cbr.daily', new_callable=AsyncMock)
+    async def test_get_currency_rate_cached(self, mock_daily):
+        # Повторные запросы курсов берутся из кэша до даты следующего обновления ленты
+        mock_daily.return_value = {
+            "Timestamp": "2024-10-17T20:00:00+03:00",
+            "NextDate": "2999-01-01T11:30:00+03:00",
+            "Valute": {"USD": {"Value": 97.0, "Name": "Доллар США", "Nominal": 1}}
+        }
+        hits, misses = currency_rates.hits, currency_rates.misses
+        # Одновременные промахи сливаются в одну загрузку
+        await asyncio.gather(*(get_currency_rate(ticker) for ticker in ("USD", "EUR", "USD")))
+        await get_currency_rate("USD")
+        self.assertEqual(mock_daily.await_count, 1)
+        self.assertEqual(currency_rates.hits - hits, 3)
+        self.assertEqual(currency_rates.misses - misses, 1)
+        self.assertEqual(currency_rates.timestamp, "2024-10-17T20:00:00+03:00")
+
+        # Ручная инвалидация заставляет скачать ленту заново
+        currency_rates.invalidate()
+        await get_currency_rate("USD")
+        self.assertEqual(mock_daily.await_count, 2)
+
+    @patch('main.binance.ticker_price', new_callable=AsyncMock)
+    async def test_get_crypto_rate(self, mock_ticker_price):
         # Пример ответа Binance API
-        mock_get_symbol_ticker.return_value = {
+        mock_ticker_price.return_value = {
             "symbol": "BTCUSDT",
             "price": "58000.50"
-        }  
-        rate = get_crypto_rate("BTC")
+        }
+        rate = await get_crypto_rate("BTC")
+        mock_ticker_price.assert_awaited_once_with("BTCUSDT")
         self.assertEqual(rate, 58000.50)
 
-    @patch('main.requests.get')
-    def test_get_stock_rate(self, mock_get):
+    async def test_get_stock_rate(self):
         # Пример ответа Alpha Vantage API
         mock_response = {
-            "Time Series (Daily)": {
-                "2024-10-16": {
-                    "4. close": "150.50"
-                }
+            "Global Quote": {
+                "01. symbol": "IBM",
+                "05. price": "150.5000",
+                "07. latest trading day": "2024-10-16"
             }
         }
-        mock_get.return_value.json.return_value = mock_response
-        rate = get_stock_rate("IBM")
-        self.assertEqual(rate, "150.50")
+        alpha_vantage = MagicMock()
+        alpha_vantage.query = AsyncMock(return_value=mock_response)
+        with patch('main.stock_quotes', StockQuotes(Database(':memory:'), alpha_vantage)):
+            rate = await get_stock_rate("IBM")
+            # Повторный запрос берётся из таблицы stock_quotes
+            self.assertEqual(await get_stock_rate("IBM"), 150.5)
+        alpha_vantage.query.assert_awaited_once_with(function='GLOBAL_QUOTE', symbol="IBM")
+        self.assertEqual(rate, 150.5)
+
+    async def test_stock_quotes_budget(self):
+        # Когда суточная квота исчерпана, отдаётся сохранённая котировка без запроса
+        alpha_vantage = MagicMock()
+        alpha_vantage.query = AsyncMock(return_value={"Global Quote": {"05. price": "10.0"}})
+        quotes = StockQuotes(Database(':memory:'), alpha_vantage, per_minute=5, per_day=1)
+        self.assertEqual((await quotes.quote("AAA")).price, 10.0)
+        quotes.db.conn.execute('UPDATE stock_quotes SET fetched_at = 0')
+
+        stale = await quotes.quote("AAA")
+        self.assertTrue(stale.stale)
+        self.assertEqual(stale.price, 10.0)
+        with self.assertRaises(ProviderError):
+            await quotes.quote("BBB")
+        self.assertEqual(alpha_vantage.query.await_count, 1)
+
+    async def test_stock_quotes_cached_only(self):
+        # Фоновые задачи получают только сохранённую котировку и не расходуют квоту
+        alpha_vantage = MagicMock()
+        alpha_vantage.query = AsyncMock(return_value={"Global Quote": {"05. price": "10.0"}})
+        quotes = StockQuotes(Database(':memory:'), alpha_vantage)
+        with self.assertRaises(ProviderError):
+            await quotes.cached("AAA")
+        await quotes.quote("AAA")
+        quotes.db.conn.execute('UPDATE stock_quotes SET fetched_at = 0')
+        stale = await quotes.cached("AAA")
+        self.assertEqual((stale.price, stale.stale), (10.0, True))
+        self.assertEqual(alpha_vantage.query.await_count, 1)
+        self.assertEqual(await quotes.budget.used_today(), 1)
+
+    async def test_stock_quotes_open_breaker_keeps_quota(self):
+        # Разомкнутый автомат не тратит квоту, а старая котировка не становится свежей
+        client = MagicMock()
+        client.query = AsyncMock(return_value={"Global Quote": {"05. price": "10.0"}})
+        alpha_vantage = GuardedClient(client, ProviderPolicy('av', hedge=False, failures=1, stale_ttl=0), ['query'])
+        quotes = StockQuotes(Database(':memory:'), alpha_vantage)
+        await quotes.quote("AAA")
+        quotes.db.conn.execute('UPDATE stock_quotes SET fetched_at = 0')
+        client.query.side_effect = ProviderError("HTTP 503")
+        for _ in range(4):
+            stale = await quotes.quote("AAA")
+            self.assertEqual((stale.price, stale.stale), (10.0, True))
+        self.assertEqual(client.query.await_count, 2)
+        self.assertEqual(await quotes.budget.used_today(), 2)
+        self.assertEqual(quotes.db.conn.execute('SELECT fetched_at FROM stock_quotes').fetchone(), (0,))
+
+    async def test_cached_stock_rate_skips_stale(self):
+        # Фоновые задачи не видят устаревшую котировку: алерт не сработает по цене недельной давности
+        alpha_vantage = MagicMock()
+        alpha_vantage.query = AsyncMock(return_value={"Global Quote": {"05. price": "10.0"}})
+        quotes = StockQuotes(Database(':memory:'), alpha_vantage)
+        with patch('main.stock_quotes', quotes):
+            await quotes.quote("AAA")
+            self.assertEqual(await main.get_cached_stock_rate("AAA"), 10.0)
+            quotes.db.conn.execute('UPDATE stock_quotes SET fetched_at = 0')
+            self.assertIsInstance(await main.get_cached_stock_rate("AAA"), str)
+            self.assertIsInstance(await main.get_cached_stock_rate("BBB"), str)
+
+    def test_market_session_freshness(self):
+        # Котировка пятничного закрытия остаётся свежей все выходные
+        friday_close = datetime(2024, 10, 18, 16, 5, tzinfo=MARKET_TZ).timestamp()
+        sunday = datetime(2024, 10, 20, 12, 0, tzinfo=MARKET_TZ)
+        monday_session = datetime(2024, 10, 21, 10, 0, tzinfo=MARKET_TZ)
+        self.assertTrue(is_fresh(friday_close, sunday, session_ttl=900))
+        self.assertFalse(is_fresh(friday_close, monday_session, session_ttl=900))
+
+    async def test_http_client_deadline(self):
+        # Медленный поставщик обрывается по дедлайну, а не держит обработчик
+        async def slow(request):
+            await asyncio.sleep(1)
+            return web.json_response({})
+
+        app = web.Application()
+        app.router.add_get('/slow', slow)
+        http = HttpClient()
+        async with TestServer(app) as server:
+            with self.assertRaises(ProviderError):
+                await http.get_json(str(server.make_url('/slow')), timeout=0.05)
+        await http.close()
+
+    async def test_valuer_batches_by_asset_type(self):
+        # Все криптоактивы оцениваются одним запросом, группы - параллельно
+        binance = MagicMock()
+        binance.ticker_prices = AsyncMock(return_value={"BTCUSDT": 60000.0, "ETHUSDT": 2500.0})
+        rates = MagicMock()
+        rates.get = AsyncMock(return_value={"Valute": {"USD": {"Value": 90.0, "Nominal": 1}, "JPY": {"Value": 60.0, "Nominal": 100}}})
+        get_stock_rate = AsyncMock(return_value="150.50")
+        valuer = Valuer(rates, binance, get_stock_rate)
+
+        prices = await valuer.price([
+            ("BTC", "crypto"), ("ETH", "crypto"), ("DOGE", "crypto"),
+            ("USD", "currency"), ("JPY", "currency"), ("IBM", "stock"),
+        ])
+
+        binance.ticker_prices.assert_awaited_once_with(["BTCUSDT", "DOGEUSDT", "ETHUSDT"])
+        rates.get.assert_awaited_once()
+        self.assertEqual(prices[("crypto", "BTC")], 60000.0)
+        self.assertEqual(prices[("crypto", "DOGE")], "Криптовалюта не найдена.")
+        self.assertEqual(prices[("currency", "JPY")], 0.6)
+        self.assertEqual(prices[("stock", "IBM")], 150.5)
+
+    async def test_valuer_retries_full_list_only_on_client_error(self):
+        binance = MagicMock()
+        binance.ticker_prices = AsyncMock(side_effect=[ProviderClientError("Invalid symbol."), {"BTCUSDT": 60000.0}])
+        valuer = Valuer(MagicMock(), binance, AsyncMock())
+        prices = await valuer.price([("BTC", "crypto"), ("BTX", "crypto")])
+        self.assertEqual(prices[("crypto", "BTC")], 60000.0)
+        self.assertEqual(binance.ticker_prices.await_count, 2)
+
+        # Сбой поставщика не порождает второй запрос всех цен биржи
+        binance.ticker_prices = AsyncMock(side_effect=ProviderError("timeout"))
+        prices = await valuer.price([("BTC", "crypto")])
+        self.assertTrue(prices[("crypto", "BTC")].startswith("Ошибка"))
+        binance.ticker_prices.assert_awaited_once()
+
+    async def test_get_crypto_rate_from_stream(self):
+        # При включённом потоке цена берётся из таблицы в памяти без REST-запроса
+        table = PriceTable(max_age=30)
+        stream = BinanceStream(HttpClient(), table, AsyncMock(return_value={"ETHUSDT"}))
+        stream.handle({"e": "24hrMiniTicker", "s": "BTCUSDT", "c": "61000.10"})
+        with patch('main.binance_stream', stream), \
+                patch('main.binance.ticker_price', new_callable=AsyncMock) as mock_ticker_price:
+            rate = await get_crypto_rate("BTC")
+            self.assertEqual(rate, 61000.10)
+            mock_ticker_price.assert_not_awaited()
+
+            # Устаревшая цена не используется, запрос уходит в REST
+            table.update("BTCUSDT", 59000.0, received_at=0)
+            mock_ticker_price.return_value = {"symbol": "BTCUSDT", "price": "62000.00"}
+            self.assertEqual(await get_crypto_rate("BTC"), 62000.0)
+        # Подписка держится на символы портфелей и недавно запрошенные
+        self.assertEqual(await stream.wanted(), {"BTCUSDT", "ETHUSDT"})
+
+class TestSQLiteStorage(AsyncTestCase):
+    async def test_state_persists_across_instances(self):
+        storage_db = Database(':memory:')
+        storage = SQLiteStorage(storage_db)
+        await storage.set_state(chat=1, user=1, state=Portfolio.waiting_for_amount)
+        await storage.update_data(chat=1, user=1, data={'asset_type': 'crypto'})
+        self.assertEqual(await storage.get_data(chat=1, user=1), {'asset_type': 'crypto'})
+        await storage.close()
+
+        # Новый процесс видит состояние из базы
+        restored = SQLiteStorage(storage_db)
+        self.assertEqual(await restored.get_state(chat=1, user=1), Portfolio.waiting_for_amount.state)
+        self.assertEqual(await restored.get_data(chat=1, user=1), {'asset_type': 'crypto'})
+
+        # Завершённый диалог удаляет строку
+        await restored.finish(chat=1, user=1)
+        await restored.close()
+        self.assertEqual(storage_db.conn.execute('SELECT COUNT(*) FROM fsm_state').fetchone()[0], 0)
+        storage_db.close()
+
+    async def test_replicas_see_state_immediately(self):
+        # Следующее обновление может попасть в другую реплику: она сразу видит новое состояние
+        storage_db = Database(':memory:')
+        first, second = SQLiteStorage(storage_db), SQLiteStorage(storage_db)
+        await first.set_state(chat=1, user=1, state='Portfolio:waiting_for_amount')
+        self.assertEqual(await second.get_state(chat=1, user=1), 'Portfolio:waiting_for_amount')
+        await first.finish(chat=1, user=1)
+        self.assertIsNone(await second.get_state(chat=1, user=1))
+
+        # Одновременные изменения разных диалогов записываются пачками, а не транзакцией на каждое
+        batches = []
+        write_batch = fsm_storage._write_batch
+
+        def counting_write_batch(conn, batch, evict_before):
+            batches.append(len(batch))
+            return write_batch(conn, batch, evict_before)
+
+        with patch('fsm_storage._write_batch', counting_write_batch):
+            await asyncio.gather(*(first.set_state(chat=n, user=n, state='Portfolio:waiting_for_amount') for n in range(20)))
+        self.assertLess(len(batches), 20)
+        self.assertEqual(storage_db.conn.execute('SELECT COUNT(*) FROM fsm_state').fetchone()[0], 20)
+        await first.close()
+        await second.close()
+        storage_db.close()
+
+    async def test_stale_states_expire(self):
+        storage_db = Database(':memory:')
+        storage = SQLiteStorage(storage_db, ttl=60, evict_interval=0)
+        await storage.set_state(chat=1, user=1, state='Portfolio:waiting_for_amount')
+        await storage.set_state(chat=2, user=2, state='Portfolio:waiting_for_amount')
+        await storage.close()
+        storage_db.conn.execute('UPDATE fsm_state SET updated_at = 0 WHERE chat = ?', ('1',))
+        self.assertIsNone(await storage.get_state(chat=1, user=1))
+
+        # Брошенные состояния удаляются при следующей записи
+        await storage.set_state(chat=3, user=3, state='Portfolio:waiting_for_amount')
+        await storage.close()
+        chats = [chat for (chat,) in storage_db.conn.execute('SELECT chat FROM fsm_state ORDER BY chat')]
+        self.assertEqual(chats, ['2', '3'])
+        storage_db.close()
+
+class TestWebhookServer(AsyncTestCase):
+    async def test_updates_are_queued_and_processed(self):
+        dp = Dispatcher(Bot(token=API_TOKEN))
+        dp.process_update = AsyncMock()
+        server = WebhookServer(dp, secret_token='secret', workers=2, queue_size=1)
+        async with TestClient(TestServer(server.app())) as client:
+            response = await client.post('/webhook', json={'update_id': 1})
+            self.assertEqual(response.status, 403)
+            response = await client.post('/webhook', json={'update_id': 1}, headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'})
+            self.assertEqual(response.status, 200)
+            for body in ('[]', '"update"', 'not json'):
+                response = await client.post('/webhook', data=body, headers={'X-Telegram-Bot-Api-Secret-Token': 'secret'})
+                self.assertEqual(response.status, 400)
+            health = await client.get('/healthz')
+            self.assertEqual((await health.json())['status'], 'ok')
+            await server._queue.join()
+        dp.process_update.assert_awaited_once()
+        self.assertEqual(dp.process_update.call_args.args[0].update_id, 1)
+        # После остановки сервер больше не принимает обновления
+        self.assertTrue(server._closing)
+
+class TestMetrics(AsyncTestCase):
+    def test_prometheus_text_format(self):
+        registry = metrics.Registry()
+        histogram = metrics.Histogram('test_seconds', "Тест", ['op'], buckets=(0.1, 1.0), registry=registry)
+        counter = metrics.Counter('test_errors_total', "Тест", ['op'], registry=registry)
+        histogram.observe(0.05, 'read')
+        histogram.observe(0.5, 'read')
+        histogram.observe(5.0, 'read')
+        counter.inc('read')
+        text = registry.render()
+        self.assertIn('test_seconds_bucket{op="read",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{op="read",le="1.0"} 2', text)
+        self.assertIn('test_seconds_bucket{op="read",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{op="read"} 3', text)
+        self.assertIn('test_errors_total{op="read"} 1', text)
+
+    async def test_handlers_are_timed_and_errors_counted(self):
+        dp = Dispatcher(Bot(token=API_TOKEN))
+
+        async def metrics_ok(message):
+            pass
+
+        async def metrics_fail(message):
+            raise ValueError("boom")
+
+        dp.register_message_handler(metrics_ok, commands=['ok'])
+        dp.register_message_handler(metrics_fail, commands=['fail'])
+        metrics.instrument(dp)
+        before = metrics.HANDLER_SECONDS.count('metrics_ok')
+
+        def update(text):
+            return types.Update(**{'update_id': 1, 'message': {
+                'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': False, 'first_name': 'test'}, 'text': text,
+            }})
+
+        await dp.process_update(update('/ok'))
+        with self.assertRaises(ValueError):
+            await dp.process_update(update('/fail'))
+        self.assertEqual(metrics.HANDLER_SECONDS.count('metrics_ok'), before + 1)
+        self.assertEqual(metrics.HANDLER_SECONDS.count('metrics_fail'), 1)
+        self.assertEqual(metrics.HANDLER_ERRORS.value('metrics_fail'), 1)
+
+    async def test_metrics_endpoint_and_profiler(self):
+        # Порт webhook открыт для Telegram - метрики и профилировщик на нём не отдаются
+        async with TestClient(TestServer(WebhookServer(Dispatcher(Bot(token=API_TOKEN))).app())) as client:
+            self.assertEqual((await client.get('/metrics')).status, 404)
+            self.assertEqual((await client.post('/debug/profiler/start')).status, 404)
+
+        app = metrics.add_routes(web.Application(), metrics.SamplingProfiler(interval=0.001))
+        async with TestClient(TestServer(app)) as client:
+            await db.get_portfolio(1)
+            text = await (await client.get('/metrics')).text()
+            self.assertIn('bot_db_query_seconds_count{query="storage._get_portfolio"}', text)
+            self.assertIn('bot_cache_hit_ratio{cache="cbr_rates"}', text)
+
+            await client.post('/debug/profiler/start')
+            deadline = asyncio.get_running_loop().time() + 0.05
+            while asyncio.get_running_loop().time() < deadline:
+                sum(range(1000))
+            report = await (await client.post('/debug/profiler/stop')).text()
+        self.assertIn('test_main.py:test_metrics_endpoint_and_profiler', report)
+
+class TestLazyStartup(unittest.TestCase):
+    def test_import_has_no_side_effects(self):
+        # Импорт модуля не требует токена, не открывает базу и не ходит в сеть
+        db_path = os.path.join(tempfile.mkdtemp(), 'never_created.db')
+        env = {key: value for key, value in os.environ.items() if key != 'API_TOKEN'}
+        env['DATABASE_PATH'] = db_path
+        code = "import main; assert main.db is None and main.http is None"
+        subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), env=env, check=True)
+        self.assertFalse(os.path.exists(db_path))
+
+    def test_create_app_registers_handlers(self):
+        with patch.dict(os.environ, {'API_TOKEN': API_TOKEN}):
+            dp = main.create_app()
+        self.assertIs(dp.storage.db, main.db)
+        handlers = [handler.handler for handler in dp.message_handlers.handlers]
+        self.assertIn(main.portfolio_command, handlers)
+        self.assertIn(main.currency_rate_command, handlers)
+
+class TestBenchmark(unittest.TestCase):
+    def test_benchmark_writes_report(self):
+        # Короткий прогон нагрузочного теста против локальной заглушки поставщиков и Bot API
+        output = os.path.join(tempfile.mkdtemp(), 'bench.json')
+        subprocess.run([
+            sys.executable, 'benchmark.py', '--users', '5', '--portfolio-sizes', '3', '--updates', '10',
+            '--warmup', '0', '--concurrency', '4', '--scenarios', 'start,portfolio',
+            '--cbr-latency', '0', '--binance-latency', '0', '--alphavantage-latency', '0', '--telegram-latency', '0',
+            '--output', output,
+        ], cwd=os.path.dirname(os.path.abspath(__file__)), check=True, capture_output=True)
+        with open(output) as file:
+            report = json.load(file)
+        self.assertEqual([result['scenario'] for result in report['results']], ['start', 'portfolio'])
+        portfolio = report['results'][1]
+        self.assertEqual(portfolio['errors'], 0)
+        self.assertEqual(portfolio['upstream_calls']['telegram'], 10)
+        self.assertIn('p99', portfolio['latency_ms'])
+
+class TestAlerts(AsyncTestCase):
+    def test_index_triggers_with_bisect(self):
+        index = AlertIndex()
+        index.add(Alert(1, 10, 'crypto', 'BTC', ABOVE, 70000.0))
+        index.add(Alert(2, 11, 'crypto', 'BTC', ABOVE, 65000.0))
+        index.add(Alert(3, 12, 'crypto', 'BTC', ABOVE, 80000.0))
+        index.add(Alert(4, 13, 'crypto', 'BTC', BELOW, 60000.0))
+        index.add(Alert(5, 14, 'currency', 'USD', BELOW, 90.0))
+
+        self.assertEqual([alert.id for alert in index.triggered('crypto', 'BTC', 70000.0)], [2, 1])
+        self.assertEqual([alert.id for alert in index.triggered('crypto', 'BTC', 59000.0)], [4])
+        self.assertEqual(index.triggered('crypto', 'BTC', 62000.0), [])
+        index.remove(2)
+        self.assertEqual([alert.id for alert in index.triggered('crypto', 'BTC', 70000.0)], [1])
+        self.assertEqual(index.symbols(), [('crypto', 'BTC'), ('currency', 'USD')])
+
+    async def test_engine_prices_each_symbol_once_per_cycle(self):
+        # Сотни пользователей с алертами на два символа - один пакетный запрос цен за цикл
+        valuer = MagicMock()
+        valuer.price = AsyncMock(return_value={('crypto', 'BTC'): 71000.0, ('currency', 'USD'): 95.0})
+        notify = AsyncMock()
+        engine = AlertEngine(Database(':memory:'), valuer, notify)
+        for user_id in range(200):
+            await engine.add(user_id, 'crypto', 'BTC', ABOVE, 70000.0 + user_id * 10)
+        await engine.add(1000, 'currency', 'USD', BELOW, 90.0)
+
+        await engine.evaluate()
+        valuer.price.assert_awaited_once()
+        self.assertEqual(sorted(valuer.price.call_args.args[0]), [('BTC', 'crypto'), ('USD', 'currency')])
+        # Сработали алерты с порогом до 71000 включительно, и каждый только один раз
+        self.assertEqual(notify.await_count, 101)
+        await engine.evaluate()
+        self.assertEqual(notify.await_count, 101)
+        self.assertEqual(len(await engine.user_alerts(150)), 1)
+        self.assertEqual(await engine.user_alerts(50), [])
+
+    async def test_alert_command_rejects_non_finite_threshold(self):
+        engine = MagicMock()
+        engine.add = AsyncMock()
+        for threshold in ('nan', 'inf', '-5', 'abc'):
+            message = MagicMock()
+            message.get_args.return_value = f"BTC > {threshold}"
+            message.reply = AsyncMock()
+            with patch('main.alert_engine', engine):
+                await main.alert_command(message)
+            message.reply.assert_awaited_once_with(main.ALERT_USAGE)
+        engine.add.assert_not_awaited()
+
+    async def test_replicas_notify_once(self):
+        # Две реплики с общей базой видят один алерт, уведомление уходит один раз
+        database = Database(':memory:')
+        valuer = MagicMock()
+        valuer.price = AsyncMock(return_value={('crypto', 'BTC'): 71000.0})
+        notify = AsyncMock()
+        engines = [AlertEngine(database, valuer, notify) for _ in range(2)]
+        await engines[0].add(1, 'crypto', 'BTC', ABOVE, 70000.0)
+        await engines[1].load()
+
+        await asyncio.gather(*(engine.evaluate() for engine in engines))
+        notify.assert_awaited_once()
+        self.assertEqual(len(engines[1].index), 0)
+
+    async def test_engine_start_stop(self):
+        # Повторный start() не плодит задачи, stop() дожидается отмены и безопасен повторно
+        engine = AlertEngine(Database(':memory:'), MagicMock(), AsyncMock(), interval=3600)
+        engine.start()
+        task = engine._task
+        engine.start()
+        self.assertIs(engine._task, task)
+        await asyncio.sleep(0)
+        await engine.stop()
+        self.assertTrue(task.cancelled())
+        self.assertIsNone(engine._task)
+        await engine.stop()
+
+class TestPriceHistory(AsyncTestCase):
+    async def test_portfolio_value_from_stored_prices(self):
+        history = PriceHistory(Database(':memory:'))
+        start = 1_700_000_000 // 300 * 300
+        for step in range(12):
+            prices = {('crypto', 'BTC'): 100.0 + step}
+            # Цена USD появляется позже - до этого стоимость портфеля не считается
+            if step >= 2:
+                prices[('currency', 'USD')] = 90.0
+            await history.append(prices, start + step * 300)
+
+        holdings = [('BTC', 2.0, 'crypto'), ('USD', 10.0, 'currency'), ('AAPL', 1000.0, 'stock')]
+        values, missing = await history.portfolio_value(holdings, '1d', now=start + 3600)
+        # У AAPL нет ни одной точки - актив не молча теряется, а возвращается отдельно
+        self.assertEqual(missing, [('stock', 'AAPL')])
+        self.assertEqual(len(values), 10)
+        self.assertEqual(values[0], (start + 600, 2 * 102.0 + 900.0))
+        self.assertEqual(values[-1], (start + 11 * 300, 2 * 111.0 + 900.0))
+
+    async def test_compact_downsamples_and_expires(self):
+        history = PriceHistory(Database(':memory:'))
+        start = 1_700_000_000 // 3600 * 3600
+        for step in range(24):
+            await history.append({('crypto', 'BTC'): float(step)}, start + step * 300)
+
+        # Через три дня точки с шагом 5 минут удалены, а часовые хранят последнюю цену каждого часа
+        await history.compact(now=start + 3 * 86400)
+        self.assertEqual(await history.series([('crypto', 'BTC')], start, start + 86400, 300), {})
+        hourly = await history.series([('crypto', 'BTC')], start, start + 86400, 3600)
+        self.assertEqual(hourly[('crypto', 'BTC')], [(start, 11.0), (start + 3600, 23.0)])
+
+    async def test_recorder_snapshots_portfolio_assets(self):
+        database = Database(':memory:')
+        database.create_tables()
+        await database.add_asset(1, 'crypto', 'BTC', 1.0)
+        await database.add_asset(2, 'crypto', 'BTC', 3.0)
+        await database.add_asset(2, 'stock', 'AAPL', 1.0)
+        valuer = MagicMock()
+        valuer.price = AsyncMock(return_value={('crypto', 'BTC'): 70000.0, ('stock', 'AAPL'): 'Ошибка: нет данных'})
+        history = PriceHistory(database)
+
+        await HistoryRecorder(history, database, valuer).snapshot()
+        self.assertEqual(sorted(valuer.price.call_args.args[0]), [('AAPL', 'stock'), ('BTC', 'crypto')])
+        series = await history.series([('crypto', 'BTC'), ('stock', 'AAPL')], 0, 2 ** 40, 300)
+        self.assertEqual(list(series), [('crypto', 'BTC')])
+
+CBR_DOCUMENT = {'Valute': {
+    'USD': {'Value': 90.0, 'Nominal': 1},
+    'EUR': {'Value': 99.0, 'Nominal': 1},
+    'CNY': {'Value': 125.0, 'Nominal': 10},
+}}
+
+class TestCrossRates(AsyncTestCase):
+    def test_matrix_from_cbr(self):
+        rates = CrossRates.from_cbr(CBR_DOCUMENT)
+        self.assertAlmostEqual(rates.rate('USD', 'RUB'), 90.0)
+        self.assertAlmostEqual(rates.rate('RUB', 'USD'), 1 / 90.0)
+        self.assertAlmostEqual(rates.rate('EUR', 'USD'), 1.1)
+        self.assertAlmostEqual(rates.rate('CNY', 'RUB'), 12.5)
+        self.assertAlmostEqual(rates.rate('USDT', 'USD'), 1.0)
+        self.assertNotIn('XYZ', rates)
+
+    def test_value_rows_in_each_user_base(self):
+        rates = CrossRates.from_cbr(CBR_DOCUMENT)
+        rows = [
+            (1, 'BTC', 0.5, 'crypto'),
+            (1, 'EUR', 100.0, 'currency'),
+            (2, 'BTC', 1.0, 'crypto'),
+            (2, 'AAPL', 2.0, 'stock'),
+            (3, 'NOPE', 1.0, 'crypto'),
+        ]
+        prices = {
+            ('crypto', 'BTC'): 60000.0, ('currency', 'EUR'): 99.0,
+            ('stock', 'AAPL'): 200.0, ('crypto', 'NOPE'): 'Криптовалюта не найдена.',
+        }
+        user_ids, totals, values, unpriced = value_rows(rows, prices, rates, {1: 'USD', 2: 'RUB'})
+        self.assertEqual(list(user_ids), [1, 2, 3])
+        self.assertAlmostEqual(totals[0], 30000.0 + 110.0)
+        self.assertAlmostEqual(totals[1], (60000.0 + 400.0) * 90.0)
+        self.assertEqual(totals[2], 0.0)
+        self.assertEqual(list(unpriced), [0, 0, 1])
+        self.assertAlmostEqual(values[1], 110.0)
+
+    async def test_totals_price_each_asset_once(self):
+        database = Database(':memory:')
+        database.create_tables()
+        for user_id in range(100):
+            await database.add_asset(user_id, 'crypto', 'BTC', 1.0)
+            await database.add_asset(user_id, 'currency', 'USD', 90.0)
+        await database.set_base_currency(7, 'RUB')
+        valuer = MagicMock()
+        valuer.price = AsyncMock(return_value={('crypto', 'BTC'): 60000.0, ('currency', 'USD'): 90.0})
+        currency_rates = MagicMock()
+        currency_rates.get = AsyncMock(return_value=CBR_DOCUMENT)
+        valuation = PortfolioValuation(database, valuer, currency_rates)
+
+        totals = await valuation.totals()
+        valuer.price.assert_awaited_once()
+        self.assertEqual(len(totals), 100)
+        self.assertAlmostEqual(totals[0][0], 60090.0)
+        self.assertEqual(totals[7][1], 'RUB')
+        self.assertAlmostEqual(totals[7][0], 60090.0 * 90.0)
+
+        holdings, total, base = await valuation.portfolio(7)
+        self.assertEqual(base, 'RUB')
+        self.assertEqual([(holding.asset_name, holding.unit) for holding in holdings], [('BTC', 'USDT'), ('USD', 'RUB')])
+        self.assertAlmostEqual(total, 60090.0 * 90.0)
+
+class TestProviderPolicy(AsyncTestCase):
+    async def test_hedged_request_beats_slow_first(self):
+        policy = ProviderPolicy('test', deadline=1.0, min_samples=1, hedge_min=0.01)
+        policy.latency.record(0.01)
+        delays = [0.5, 0.0]
+
+        async def fetch():
+            await asyncio.sleep(delays.pop(0))
+            return 42
+
+        started = asyncio.get_running_loop().time()
+        self.assertEqual(await policy.call('key', fetch), 42)
+        self.assertLess(asyncio.get_running_loop().time() - started, 0.3)
+        self.assertEqual(policy.hedged, 1)
+
+    async def test_open_breaker_serves_last_known_good(self):
+        policy = ProviderPolicy('test', deadline=0.05, hedge=False, failures=2, reset_after=60)
+        self.assertEqual(await policy.call('BTC', AsyncMock(return_value=100.0)), 100.0)
+        failing = AsyncMock(side_effect=ProviderError("down"))
+        for _ in range(2):
+            self.assertEqual(await policy.call('BTC', failing), 100.0)
+        self.assertEqual(policy.breaker.state, 'open')
+
+        # Пока автомат разомкнут, поставщик не вызывается, а ключ без сохранённой цены сразу получает ошибку
+        self.assertEqual(await policy.call('BTC', failing), 100.0)
+        self.assertEqual(failing.await_count, 2)
+        with self.assertRaises(ProviderError):
+            await policy.call('ETH', failing)
+        fallback = AsyncMock(return_value=5.0)
+        self.assertEqual(await policy.call('ETH', failing, fallback), 5.0)
+
+    async def test_deadline_bounds_slow_provider(self):
+        policy = ProviderPolicy('test', deadline=0.05, hedge=False)
+
+        async def slow():
+            await asyncio.sleep(1)
+
+        with self.assertRaises(ProviderError):
+            await policy.call('key', slow)
+
+    async def test_client_errors_keep_breaker_closed(self):
+        # Ответы 400 на неверный тикер не размыкают автомат и не подменяются сохранённой ценой
+        async def ticker(request):
+            if request.query['symbol'] == 'BTCUSDT':
+                return web.json_response({'symbol': 'BTCUSDT', 'price': '60000.0'})
+            return web.json_response({'code': -1121, 'msg': 'Invalid symbol.'}, status=400)
+
+        app = web.Application()
+        app.router.add_get('/api/v3/ticker/price', ticker)
+        http = HttpClient()
+        async with TestServer(app) as server:
+            policy = ProviderPolicy('binance', deadline=1.0, hedge=False, failures=2, reset_after=60)
+            binance = GuardedClient(BinanceClient(http, str(server.make_url(''))), policy, ['ticker_price'])
+            for symbol in ('BTXUSDT', 'ETHHUSDT', 'BTXUSDT', 'XRPPUSDT', 'DOGGUSDT'):
+                with self.assertRaises(ProviderClientError):
+                    await binance.ticker_price(symbol)
+            self.assertEqual(policy.breaker.state, 'closed')
+            self.assertEqual(policy.failures, 0)
+            self.assertEqual((await binance.ticker_price('BTCUSDT'))['price'], '60000.0')
+        await http.close()
+
+    async def test_last_good_is_bounded(self):
+        policy = ProviderPolicy('test', hedge=False, stale_keys=2)
+        for key in ('a', 'b', 'c'):
+            await policy.call(key, AsyncMock(return_value=key))
+        self.assertEqual(list(policy._last_good), ['b', 'c'])
 
+class TestDigest(AsyncTestCase):
+    async def make_broadcaster(self, send, users=5):
+        database = Database(':memory:')
+        database.create_tables()
+        valuer = MagicMock()
+        valuer.price = AsyncMock(return_value={('crypto', 'BTC'): 60000.0})
+        currency_rates = MagicMock()
+        currency_rates.get = AsyncMock(return_value=CBR_DOCUMENT)
+        broadcaster = DigestBroadcaster(
+            database, PortfolioValuation(database, valuer, currency_rates), send, global_rate=1000, chat_rate=1000,
+            chunk_size=2,
+        )
+        for user_id in range(1, users + 1):
+            await database.add_asset(user_id, 'crypto', 'BTC', float(user_id))
+            await broadcaster.subscribe(user_id, 'daily')
+        return broadcaster, valuer
+
+    async def test_cycle_uses_one_snapshot_and_runs_once(self):
+        send = AsyncMock()
+        broadcaster, valuer = await self.make_broadcaster(send)
+        await broadcaster.unsubscribe(5)
+        cycle = broadcaster.cycle('daily')
+
+        self.assertEqual(await broadcaster.run_cycle('daily', cycle), 4)
+        valuer.price.assert_awaited_once()
+        self.assertEqual(send.call_args_list[0].args, (1, "📊 Ежедневная сводка: стоимость портфеля 60000.00 USD"))
+        self.assertEqual(await broadcaster.run_cycle('daily', cycle), 0)
+        self.assertEqual(send.await_count, 4)
+
+    async def test_cycle_resumes_without_duplicates(self):
+        calls = []
+
+        async def send(chat_id, text):
+            calls.append(chat_id)
+            if chat_id == 4:
+                # Первый раз процесс останавливается посреди порции, второй - сетевой сбой
+                raise asyncio.CancelledError() if calls.count(4) == 1 else RuntimeError("connection reset")
+            if chat_id == 2 and calls.count(2) == 1:
+                raise RetryAfter(0)
+            if chat_id == 5:
+                raise BotBlocked("Forbidden: bot was blocked by the user")
+
+        broadcaster, _ = await self.make_broadcaster(send)
+        cycle = broadcaster.cycle('daily')
+        with self.assertRaises(asyncio.CancelledError):
+            await broadcaster.run_cycle('daily', cycle)
+        await asyncio.sleep(0.05)
+
+        # Другая реплика не берёт цикл, пока аренда первой не истекла
+        replica = DigestBroadcaster(
+            broadcaster.db, broadcaster.valuation, send, global_rate=1000, chat_rate=1000, chunk_size=2,
+        )
+        self.assertEqual(await replica.run_cycle('daily', cycle), 0)
+        broadcaster.db.conn.execute('UPDATE digest_runs SET lease_until = 0')
+        # После истечения аренды цикл продолжается: пользователь 3 из прерванной порции уже получил сводку,
+        # сетевой сбой у пользователя 4 не обрывает цикл
+        self.assertEqual(await replica.run_cycle('daily', cycle), 0)
+        self.assertEqual(calls, [1, 2, 2, 3, 4, 4, 5])
+        self.assertIsNone(await broadcaster.subscription(5))
+        self.assertEqual(await broadcaster.run_cycle('daily', cycle), 0)
+        self.assertEqual(len(calls), 7)
+
+class TestFinanceBot(unittest.TestCase):
     def test_database_insert_user(self):
         # Вставка данных пользователя в базу данных
-        cursor.execute('INSERT INTO users (user_id, username) VALUES (?, ?)', (12345, "test_user"))
-        conn.commit()
+        db.conn.execute('INSERT INTO users (user_id, username) VALUES (?, ?)', (12345, "test_user"))
+        db.conn.commit()
         # Проверка, что пользователь был добавлен
-        cursor.execute('SELECT username FROM users WHERE user_id = ?', (12345,))
-        result = cursor.fetchone()
+        result = db.conn.execute('SELECT username FROM users WHERE user_id = ?', (12345,)).fetchone()
         self.assertEqual(result[0], "test_user")
     def test_database_insert_portfolio(self):
         # Добавляем запись в таблицу portfolio
-        cursor.execute('''
+        db.conn.execute('''
             INSERT INTO portfolio (user_id, asset_name, amount, asset_type)
             VALUES (?, ?, ?, ?)
         ''', (12345, 'BTC', 1.5, 'crypto'))
-        conn.commit()
+        db.conn.commit()
         # Проверка, что актив был добавлен
-        cursor.execute('SELECT amount FROM portfolio WHERE user_id = ? AND asset_name = ?', (12345, 'BTC'))
-        result = cursor.fetchone()
+        result = db.conn.execute('SELECT amount FROM portfolio WHERE user_id = ? AND asset_name = ?', (12345, 'BTC')).fetchone()
         self.assertEqual(result[0], 1.5)
+    def setUp(self):
+        self.tearDown()
     def tearDown(self):
         # Очистка базы данных после каждого теста
-        cursor.execute('DELETE FROM users WHERE user_id = ?', (12345,))
-        cursor.execute('DELETE FROM portfolio WHERE user_id = ?', (12345,))
-        conn.commit()
+        db.conn.execute('DELETE FROM users WHERE user_id = ?', (12345,))
+        db.conn.execute('DELETE FROM portfolio WHERE user_id = ?', (12345,))
+        db.conn.commit()
+
+class TestStorage(AsyncTestCase):
+    async def test_add_asset_upsert(self):
+        # Повторное добавление актива прибавляет количество к той же строке
+        storage = Database(':memory:')
+        storage.create_tables()
+        self.assertEqual(await storage.add_asset(1, 'crypto', 'BTC', 1.5), 1.5)
+        self.assertEqual(await storage.add_asset(1, 'crypto', 'BTC', 0.5), 2.0)
+        await storage.add_asset(2, 'crypto', 'BTC', 3.0)
+        self.assertEqual(await storage.get_portfolio(1), [('BTC', 2.0, 'crypto')])
+        self.assertEqual(await storage.asset_names('crypto'), ['BTC'])
+        storage.close()
+
+    def test_create_tables_adds_base_currency(self):
+        storage = Database(':memory:')
+        storage.conn.execute('CREATE TABLE users (user_id INTEGER PRIMARY KEY, username TEXT)')
+        storage.conn.execute("INSERT INTO users VALUES (1, 'old_user')")
+        storage.create_tables()
+        self.assertEqual(storage.conn.execute('SELECT base_currency FROM users').fetchall(), [('USD',)])
+
+    def test_create_tables_merges_duplicates(self):
+        # Дубликаты из старой схемы сливаются перед созданием уникального индекса
+        storage = Database(':memory:')
+        storage.conn.execute('CREATE TABLE portfolio (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, asset_name TEXT, amount REAL, asset_type TEXT)')
+        storage.conn.executemany(
+            'INSERT INTO portfolio (user_id, asset_name, amount, asset_type) VALUES (?, ?, ?, ?)',
+            [(1, 'BTC', 1.0, 'crypto'), (1, 'BTC', 2.0, 'crypto'), (1, 'USD', 5.0, 'currency')],
+        )
+        storage.create_tables()
+        rows = storage.conn.execute('SELECT asset_name, amount FROM portfolio ORDER BY asset_name').fetchall()
+        self.assertEqual(rows, [('BTC', 3.0), ('USD', 5.0)])
+        storage.close()
 
 class TestPortfolioHandlers(AsyncTestCase):
     def setUp(self):
@@ -121,6 +840,48 @@ class TestPortfolioHandlers(AsyncTestCase):
         message.text = "BTC"
         message.reply = AsyncMock()
 
+    async def test_process_asset_ticker_typo(self):
+        # Неизвестный тикер отклоняется по локальному индексу, с подсказками по префиксу
+        message = MagicMock(Message)
+        message.text = "BTX"
+        message.reply = AsyncMock()
+        state = AsyncMock(FSMContext)
+        state.get_data = AsyncMock(return_value={'asset_type': 'crypto'})
+        index = SymbolIndex()
+        index.load('crypto', ['BTC', 'BTTC', 'ETH'])
+
+        with patch('main.symbol_index', index), patch('main.get_crypto_rate', new_callable=AsyncMock) as mock_rate:
+            await process_asset_ticker(message, state)
+
+        mock_rate.assert_not_awaited()
+        state.update_data.assert_not_called()
+        self.assertIn("BTX не найден", message.reply.call_args.args[0])
+        markup = message.reply.call_args.kwargs['reply_markup']
+        self.assertEqual([button.text for button in markup.inline_keyboard[0]], ['BTC', 'BTTC'])
+
+    async def test_symbol_loader_backs_off_after_failure(self):
+        # Неудачная загрузка списка акций не повторяется каждую минуту и не тратит квоту
+        index = SymbolIndex()
+        load = AsyncMock(side_effect=ProviderError("timeout"))
+        loader = SymbolLoader(index, {'stock': (load, 86400)})
+        await loader.refresh()
+        await loader.refresh()
+        await loader.ensure(['stock'])
+        self.assertEqual(load.await_count, 1)
+        load.side_effect = None
+        load.return_value = ['IBM']
+        await loader.refresh(force=True)
+        self.assertTrue(index.contains('stock', 'IBM'))
+
+    def test_symbol_index_prefix(self):
+        index = SymbolIndex()
+        self.assertIsNone(index.contains('stock', 'IBM'))
+        index.load('stock', ['ibm', 'IBKR', 'AAPL', 'IBN'])
+        self.assertTrue(index.contains('stock', 'IBM'))
+        self.assertFalse(index.contains('stock', 'IBX'))
+        self.assertEqual(index.prefix('stock', 'ib'), ['IBKR', 'IBM', 'IBN'])
+        self.assertEqual(index.prefix('stock', 'IB', limit=2), ['IBKR', 'IBM'])
+
     @patch('main.get_crypto_rate', return_value=50000.0)
     async def test_process_asset_amount_crypto(self, mock_get_crypto_rate):
         message = MagicMock(Message)
@@ -142,5 +903,73 @@ class TestPortfolioHandlers(AsyncTestCase):
         message.reply.assert_called_once_with("BTC в количестве 1.5 добавлен в ваше портфолио.")
         state.finish.assert_called_once()
 
+class TestPortfolioIO(AsyncTestCase):
+    def parse(self, text, fmt, **kwargs):
+        return portfolio_io.parse(io.BytesIO(text.encode('utf-8')), fmt, **kwargs)
+
+    def test_parse_csv_semicolon(self):
+        # CSV из Excel: BOM, точка с запятой, десятичная запятая, повтор актива суммируется
+        rows, errors = self.parse(
+            "\ufeffТип;Тикер;Количество\ncrypto;btc;1,5\nstock;AAPL;10\ncrypto;BTC;0,5\nbond;X;1\n\n", 'csv'
+        )
+        self.assertEqual([(row.asset_type, row.asset_name, row.amount) for row in rows],
+                         [('crypto', 'BTC', 2.0), ('stock', 'AAPL', 10.0)])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('Строка 5'))
+
+    def test_parse_json_stream(self):
+        # Массив читается порциями меньше одного объекта; JSON Lines тоже разбирается
+        text = json.dumps([{'asset_type': 'crypto', 'asset_name': 'ETH', 'amount': 2},
+                           {'asset_type': 'currency', 'asset_name': 'EUR', 'amount': -1}])
+        records = list(portfolio_io._json_records(io.StringIO(text), chunk_size=7))
+        self.assertEqual([number for number, _ in records], [1, 2])
+        rows, errors = self.parse(text, 'json')
+        self.assertEqual([(row.asset_name, row.amount) for row in rows], [('ETH', 2.0)])
+        self.assertEqual(len(errors), 1)
+        rows, errors = self.parse('{"type": "stock", "ticker": "MSFT", "qty": "3"}\n{"type": "stock", "qty": 1}\n', 'json')
+        self.assertEqual([row.asset_name for row in rows], ['MSFT'])
+        self.assertEqual(errors, ["Запись 2: не указан тикер"])
+        with self.assertRaises(portfolio_io.PortfolioFileError):
+            self.parse('[{"asset_type": "crypto",', 'json')
+        with self.assertRaises(portfolio_io.PortfolioFileError):
+            self.parse("type,ticker,amount\n" + "crypto,BTC,1\n" * 3, 'csv', max_rows=2)
+
+    async def test_import_export_roundtrip(self):
+        # Импорт задаёт количества (повторный импорт не удваивает их), экспорт возвращает тот же портфель
+        storage = Database(':memory:')
+        storage.create_tables()
+        await storage.add_asset(1, 'crypto', 'BTC', 5.0)
+        await storage.set_assets(1, [('crypto', 'BTC', 1.5), ('stock', 'AAPL', 10.0)])
+        await storage.set_assets(1, [('crypto', 'BTC', 1.5), ('stock', 'AAPL', 10.0)])
+        for fmt in portfolio_io.FORMATS:
+            file = io.StringIO(newline='')
+            self.assertEqual(storage.call(portfolio_io.export, 1, fmt, file), 2)
+            rows, errors = self.parse(file.getvalue(), fmt)
+            self.assertEqual(errors, [])
+            self.assertEqual(sorted((row.asset_type, row.asset_name, row.amount) for row in rows),
+                             [('crypto', 'BTC', 1.5), ('stock', 'AAPL', 10.0)])
+        storage.close()
+
+    def test_parse_rejects_bad_input(self):
+        # CSV из Excel в cp1251 читается, нечисловые количества и битый CSV не роняют импорт
+        rows, errors = portfolio_io.parse(io.BytesIO("Тип;Тикер;Количество\ncurrency;usd;10\n".encode('cp1251')), 'csv')
+        self.assertEqual([(row.asset_name, row.amount) for row in rows], [('USD', 10.0)])
+        rows, errors = self.parse("type,ticker,amount\ncrypto,BTC,nan\ncrypto,ETH,inf\n", 'csv')
+        self.assertEqual((rows, len(errors)), ([], 2))
+        with self.assertRaises(portfolio_io.PortfolioFileError):
+            portfolio_io.parse(io.BytesIO(b'[{"asset_name": "\xff"}]'), 'json')
+        with self.assertRaises(portfolio_io.PortfolioFileError):
+            self.parse('type,ticker,amount\ncrypto,"' + 'X' * 200000 + '",1\n', 'csv')
+
+    def test_check_assets_uses_index(self):
+        # Неизвестен только тикер, которого нет в загруженном списке; без списка строка не отбрасывается
+        index = SymbolIndex()
+        index.load('crypto', ['BTC'])
+        rows = [portfolio_io.ImportRow(n, asset_type, name, 1.0) for n, (asset_type, name) in enumerate(
+            [('crypto', 'BTC'), ('crypto', 'XYZ'), ('stock', 'AAPL')], start=2)]
+        unknown, unchecked = portfolio_io.check_assets(rows, index)
+        self.assertEqual(unknown, {('crypto', 'XYZ')})
+        self.assertEqual(unchecked, {('stock', 'AAPL')})
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,84 @@
+import asyncio
+from providers import ProviderClientError
+
+# Пакетная оценка активов: активы группируются по типу, каждая группа
+# оценивается одним запросом к своему поставщику, а группы запрашиваются параллельно.
+# Результат - словарь {(asset_type, asset_name): цена или строка с ошибкой}.
+class Valuer:
+    def __init__(self, currency_rates, binance, get_stock_rate, stream=None, stock_concurrency=5):
+        self.currency_rates = currency_rates
+        self.binance = binance
+        self.stream = stream  # поток котировок Binance, если включён
+        self.get_stock_rate = get_stock_rate  # у Alpha Vantage нет пакетного бесплатного запроса
+        self._stock_limit = asyncio.Semaphore(stock_concurrency)
+
+    async def price(self, assets):
+        groups = {}
+        for asset_name, asset_type in assets:
+            groups.setdefault(asset_type, set()).add(asset_name)
+
+        pricers = {
+            'crypto': self._price_crypto,
+            'currency': self._price_currency,
+            'stock': self._price_stock,
+        }
+        types = [asset_type for asset_type in groups if asset_type in pricers]
+        results = await asyncio.gather(
+            *(pricers[asset_type](groups[asset_type]) for asset_type in types),
+            return_exceptions=True,
+        )
+
+        prices = {}
+        for asset_type, result in zip(types, results):
+            for asset_name in groups[asset_type]:
+                if isinstance(result, Exception):
+                    prices[(asset_type, asset_name)] = f"Ошибка: {result}"
+                else:
+                    prices[(asset_type, asset_name)] = result[asset_name]
+        return prices
+
+    async def _price_crypto(self, names):
+        symbols = {name: f"{name}USDT" for name in names}
+        tickers = {}
+        if self.stream is not None:
+            for symbol in symbols.values():
+                price = self.stream.quote(symbol)
+                if price is not None:
+                    tickers[symbol] = price
+        missing = sorted(set(symbols.values()) - set(tickers))
+        if missing:
+            try:
+                tickers.update(await self.binance.ticker_prices(missing))
+            except ProviderClientError:
+                # Один неверный символ ломает весь пакетный запрос (ответ 400) - берём цены всех символов биржи.
+                # Таймаут или разомкнутый автомат пробрасываются: второй запрос лишь удвоил бы задержку
+                tickers.update(await self.binance.ticker_prices())
+        return {
+            name: tickers.get(symbol, "Криптовалюта не найдена.")
+            for name, symbol in symbols.items()
+        }
+
+    async def _price_currency(self, names):
+        rates = (await self.currency_rates.get())['Valute']
+        prices = {}
+        for name in names:
+            if name in rates:
+                prices[name] = rates[name]['Value'] / rates[name]['Nominal']  # Цена за единицу валюты
+            else:
+                prices[name] = "Ошибка при получении курса"
+        return prices
+
+    async def _price_stock(self, names):
+        names = list(names)
+        rates = await asyncio.gather(*(self._stock_rate(name) for name in names))
+        return dict(zip(names, rates))
+
+    async def _stock_rate(self, name):
+        async with self._stock_limit:
+            rate = await self.get_stock_rate(name)
+        if not rate:
+            return "Ошибка при получении цены"
+        try:
+            return float(rate)
+        except (TypeError, ValueError):
+            return rate
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+
+log = logging.getLogger(__name__)
+
+# Приём обновлений Telegram через webhook. Обновления складываются в ограниченную
+# очередь и обрабатываются фиксированным числом воркеров; при переполнении очереди
+# Telegram получает 503 и повторяет доставку позже.
+class WebhookServer:
+    def __init__(self, dp: Dispatcher, path='/webhook', secret_token=None, workers=16, queue_size=1000, drain_timeout=25):
+        self.dp = dp
+        self.path = path
+        self.secret_token = secret_token
+        self.workers = workers
+        self.queue_size = queue_size
+        self.drain_timeout = drain_timeout  # сколько ждать обработки очереди при остановке
+        self._queue = None
+        self._tasks = []
+        self._closing = False
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get('/healthz', self.health)
+        # /metrics и профилировщик сюда не добавляются: порт webhook открыт для Telegram,
+        # они отдаются отдельным сервером metrics.MetricsServer на внутреннем порту
+        app.on_startup.append(self._start_workers)
+        app.on_shutdown.append(self._drain)
+        return app
+
+    async def handle_update(self, request):
+        if self.secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            return web.Response(status=403)
+        if self._closing:
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        # Корректный JSON, но не объект (например, []) - тоже ошибка запроса, а не 500
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        try:
+            update = types.Update(**data)
+        except (TypeError, ValueError):
+            return web.Response(status=400)
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return web.Response(status=503)
+        return web.Response(text='ok')
+
+    # Проверка живости для обратного прокси: при остановке реплика выводится из балансировки
+    async def health(self, request):
+        status = 503 if self._closing else 200
+        return web.json_response(
+            {'status': 'stopping' if self._closing else 'ok', 'queue': self._queue.qsize() if self._queue else 0},
+            status=status,
+        )
+
+    async def _start_workers(self, app):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def _worker(self):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.dp.process_update(update)
+            except Exception:
+                log.exception("Failed to process update %s", update.update_id)
+            finally:
+                self._queue.task_done()
+
+    # Корректная остановка: новые обновления не принимаются, очередь дообрабатывается
+    async def _drain(self, app):
+        self._closing = True
+        try:
+            await asyncio.wait_for(self._queue.join(), self.drain_timeout)
+        except asyncio.TimeoutError:
+            log.warning("Webhook queue not drained, %s updates dropped", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def run_webhook(dp: Dispatcher, url, path='/webhook', host='0.0.0.0', port=8000, secret_token=None,
+                workers=16, queue_size=1000, on_startup=None, on_shutdown=None):
+    server = WebhookServer(dp, path, secret_token=secret_token, workers=workers, queue_size=queue_size)
+    app = server.app()
+
+    async def startup(app):
+        Bot.set_current(dp.bot)
+        Dispatcher.set_current(dp)
+        if on_startup is not None:
+            await on_startup(dp)
+        # Все реплики регистрируют один и тот же адрес за обратным прокси
+        if url:
+            await dp.bot.set_webhook(url + path, secret_token=secret_token)
+
+    async def cleanup(app):
+        if on_shutdown is not None:
+            await on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        session = await dp.bot.get_session()
+        await session.close()
+
+    app.on_startup.append(startup)
+    app.on_cleanup.append(cleanup)
+    web.run_app(app, host=host, port=port)